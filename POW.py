@@ -4,40 +4,186 @@ import random
 import hashlib
 import time
 import string
+import queue
+import multiprocessing
 
+#Nonces a worker tries between checks for cancellation
+BATCH_SIZE = 20000
 
+#Three digit suffixes, nonces are hashed as the digits of nonce // 1000 followed by one of these
+_SUFFIXES = [("%03d" % low).encode("ascii") for low in range(1000)]
+_SHORT_SUFFIXES = [str(low).encode("ascii") for low in range(1000)]
+_targets = {}
+
+def difficulty_target(POW_difficulty):
+    """ Digests below the returned bytes start with POW_difficulty zero hex digits """
+    target = _targets.get(POW_difficulty)
+    if target is None:
+        if POW_difficulty <= 0:
+            target = b"\xff" * 33
+        elif POW_difficulty > 64:
+            target = b""
+        else:
+            target = (1 << (256 - 4 * POW_difficulty)).to_bytes(32, "big")
+        _targets[POW_difficulty] = target
+    return target
 
 def find_nonce(hash_value, POW_difficulty):
+    return _find_from(hash_value, POW_difficulty, 1)
+
+def find_nonce_random_start(hash_value, POW_difficulty):
+    return _find_from(hash_value, POW_difficulty, random.randint(1,10000000000000) + 1)
 
-    nonce = 0
-    target = ""
-    result = ""
-    for _ in range(POW_difficulty):
-        target = target + "0"
+def _find_from(hash_value, POW_difficulty, nonce):
+    while True:
+        result = search_range(hash_value, POW_difficulty, nonce, BATCH_SIZE)
+        if result is not None:
+            return result
+        nonce = nonce + BATCH_SIZE
 
-    while result[:POW_difficulty] != target:
-        nonce = nonce + 1
-        result = hashlib.sha256((hash_value+str(nonce)).encode('utf-8')).hexdigest()
+def search_range(hash_value, POW_difficulty, start, count):
+    """ Search count nonces starting at start, returns the winning nonce or None
 
-    return nonce
+    The prefix is absorbed into a sha256 object once, and again with the leading
+    digits of each run of 1000 nonces, so each nonce only copies that midstate and
+    hashes a precomputed three digit suffix. The raw digest is compared against
+    the difficulty target instead of checking hex digits.
+    """
+    target = difficulty_target(POW_difficulty)
+    midstate = hashlib.sha256(hash_value.encode('utf-8'))
+    nonce = start
+    end = start + count
+    while nonce < end:
+        high, low = divmod(nonce, 1000)
+        stop = min(end - high * 1000, 1000)
+        prefix = midstate.copy()
+        if high > 0:
+            prefix.update(str(high).encode("ascii"))
+            suffixes = _SUFFIXES
+        else:
+            suffixes = _SHORT_SUFFIXES
+        copy = prefix.copy
+        for low in range(low, stop):
+            result = copy()
+            result.update(suffixes[low])
+            if result.digest() < target:
+                return high * 1000 + low
+        nonce = high * 1000 + 1000
+    return None
 
-def find_nonce_random_start(hash_value, POW_difficulty):
+def _mine_worker(index, processes, tasks, results, job, counters):
+    """ Worker process loop, searches its share of the nonce space for each job
+
+    Batches are interleaved between workers: worker i takes batches i, i + processes, ...
+    The search stops as soon as the shared job number moves on.
+    """
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job_id, hash_value, POW_difficulty, start = task
+        batch = index
+        while job.value == job_id:
+            nonce = search_range(hash_value, POW_difficulty, start + batch * BATCH_SIZE, BATCH_SIZE)
+            counters[index] += BATCH_SIZE
+            if nonce is not None:
+                results.put((job_id, nonce))
+                break
+            batch = batch + processes
+
+class Miner:
+    """ Pool of worker processes searching disjoint parts of the nonce space
+
+    mine() blocks until a nonce is found or cancel() is called, so it is meant
+    to be run with threads.deferToThread
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.job = multiprocessing.Value("q", 0)
+        self.counters = multiprocessing.Array("Q", self.processes, lock=False)
+        self.results = multiprocessing.Queue()
+        self.tasks = []
+        self.workers = []
+        self.last_sample = (time.time(), 0)
+
+    def start(self):
+        """ Start the worker processes, does nothing if they are running """
+        if self.workers:
+            return
+        for index in range(self.processes):
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=_mine_worker,
+                args=(index, self.processes, tasks, self.results, self.job, self.counters), daemon=True)
+            worker.start()
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+
+    def stop(self):
+        self.cancel()
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.tasks = []
+        self.workers = []
+
+    def cancel(self):
+        """ Stop the running search, mine() then returns None """
+        with self.job.get_lock():
+            self.job.value += 1
+
+    def mine(self, hash_value, POW_difficulty):
+        """ Return a nonce for hash_value, or None if the search was cancelled """
+        with self.job.get_lock():
+            self.job.value += 1
+            job_id = self.job.value
+        start = random.randint(1,10000000000000)
+        for tasks in self.tasks:
+            tasks.put((job_id, hash_value, POW_difficulty, start))
+
+        while True:
+            try:
+                found_id, nonce = self.results.get(timeout=0.5)
+            except queue.Empty:
+                found_id = None
+
+            if found_id == job_id:
+                #Move the job on so the other workers stop searching
+                with self.job.get_lock():
+                    if self.job.value == job_id:
+                        self.job.value += 1
+                return nonce
+
+            #Hand results of a newer search back to the call waiting for them
+            if found_id is not None and found_id == self.job.value:
+                self.results.put((found_id, nonce))
 
-    nonce = random.randint(1,10000000000000)
-    target = ""
-    result = ""
-    for _ in range(POW_difficulty):
-        target = target + "0"
+            if self.job.value != job_id:
+                return None
 
-    while result[:POW_difficulty] != target:
-        nonce = nonce + 1
-        result = hashlib.sha256((hash_value+str(nonce)).encode('utf-8')).hexdigest()
+    def hashes(self):
+        """ Total number of hashes computed by the workers """
+        return sum(self.counters)
 
-    return nonce
+    def hash_rate(self):
+        """ Hashes per second across all workers since the previous call """
+        now = time.time()
+        total = self.hashes()
+        last_time, last_total = self.last_sample
+        self.last_sample = (now, total)
+        if now == last_time:
+            return 0
+        return (total - last_total) / (now - last_time)
 
 if __name__ == "__main__":
    
     #letters = string.ascii_lowercase
     # hash_value = "".join(random.choice(letters) for i in range(32))
     hash_value="abcdefghijklmonp"
-    print(find_nonce_random_start(hash_value, 6))
\ No newline at end of file
+    miner = Miner()
+    miner.start()
+    miner.hash_rate()
+    print(miner.mine(hash_value, 6))
+    print(str(int(miner.hash_rate())) + " hashes/s on " + str(miner.processes) + " processes")
+    miner.stop()
\ No newline at end of file
@@ -0,0 +1,213 @@
+"""
+
+asyncio runtime for a node
+
+Runs the NodeFactory, NodeProtocol and CommandProtocol of node.py on an asyncio
+event loop instead of the Twisted reactor, using uvloop when it is installed.
+The protocols keep their logic and wire format, asyncio connections and stdin
+are fed to them through small transport adapters, and the calls the factory
+makes on the reactor are answered by the loop. Work the factory sends to
+threads, mining and block checks, runs on the loop's default executor.
+
+"python xcoin.py --asyncio" starts a node on this runtime.
+
+"""
+
+import asyncio
+import sys
+from twisted.internet import defer
+from twisted.internet.error import ConnectionDone
+from twisted.python import failure
+from node import NodeFactory
+
+def new_event_loop():
+    """ uvloop's event loop when it is installed, asyncio's otherwise """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+#Peer address with the fields NodeFactory reads from Twisted's IPv4Address
+class Address:
+    def __init__ (self, host, port):
+        self.host = host
+        self.port = port
+
+
+class Transport:
+    """ The part of a Twisted transport the protocols use, over an asyncio transport
+
+    Like Twisted, writes made while handling one event are sent together, so
+    replies to a burst of messages go out in one send call instead of one each.
+    """
+
+    def __init__ (self, transport, loop):
+        self.transport = transport
+        self.loop = loop
+        self.pending = []
+
+    #LineReceiver stops reading lines once the connection is closing
+    @property
+    def disconnecting(self):
+        return self.transport.is_closing()
+
+    def write(self, data):
+        if len(self.pending) == 0:
+            self.loop.call_soon(self.flush)
+        self.pending.append(data)
+
+    def writeSequence(self, data):
+        for part in data:
+            self.write(part)
+
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        if not self.transport.is_closing():
+            self.transport.write(b"".join(pending))
+
+    def loseConnection(self):
+        self.flush()
+        self.transport.close()
+
+    def getPeer(self):
+        host, port = self.transport.get_extra_info("peername")[:2]
+        return Address(host, port)
+
+
+class PeerConnection(asyncio.Protocol):
+    """ Feeds an asyncio connection to the NodeProtocol the factory builds for it """
+
+    def __init__ (self, factory, loop):
+        self.factory = factory
+        self.loop = loop
+        self.protocol = None
+
+    def connection_made(self, transport):
+        host, port = transport.get_extra_info("peername")[:2]
+        self.protocol = self.factory.buildProtocol(Address(host, port))
+        #The factory turns down peers it is already connected to
+        if self.protocol is None:
+            transport.close()
+            return
+        self.protocol.makeConnection(Transport(transport, self.loop))
+
+    def data_received(self, data):
+        if self.protocol is not None:
+            self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        if self.protocol is not None:
+            self.protocol.connectionLost(failure.Failure(exc or ConnectionDone()))
+
+
+#Console output for CommandProtocol
+class ConsoleTransport:
+    def __init__ (self, protocol):
+        self.protocol = protocol
+        self.disconnecting = False
+
+    def write(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def writeSequence(self, data):
+        self.write(b"".join(data))
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self.protocol.connectionLost(failure.Failure(ConnectionDone()))
+
+
+class ConsoleInput(asyncio.Protocol):
+    """ Feeds stdin to a CommandProtocol, the node stops when stdin closes """
+
+    def __init__ (self, protocol):
+        self.protocol = protocol
+
+    def data_received(self, data):
+        self.protocol.dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.protocol.connectionLost(failure.Failure(exc or ConnectionDone()))
+
+
+class Reactor:
+    """ The calls NodeFactory and its helpers make on the Twisted reactor, answered by an asyncio loop """
+
+    def __init__ (self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+    def callLater(self, delay, function, *args):
+        return self.loop.call_later(delay, function, *args)
+
+    def connectTCP(self, host, port, factory):
+        self.loop.create_task(connect(self.loop, host, port, factory))
+
+    def stop(self):
+        self.loop.stop()
+
+
+async def connect(loop, host, port, factory):
+    try:
+        await loop.create_connection(lambda: PeerConnection(factory, loop), host, port)
+    except OSError as e:
+        print("could not connect to " + host + ": " + str(e))
+
+async def listen(loop, port, factory):
+    """ Accept peer connections on port, returns the asyncio server """
+    return await loop.create_server(lambda: PeerConnection(factory, loop), port=port)
+
+async def ping_peers(factory, interval):
+    """ Pings measure the latency used to pick which peer to ask for blocks """
+    while True:
+        await asyncio.sleep(interval)
+        factory.pingPeers()
+
+
+class AsyncioNodeFactory(NodeFactory):
+    """ NodeFactory whose thread work runs on the loop's default executor """
+
+    def deferToThread(self, function, *args):
+        d = defer.Deferred()
+        future = self.reactor.loop.run_in_executor(None, function, *args)
+        future.add_done_callback(lambda future: fire(d, future))
+        return d
+
+#Pass the result of an executor future to a Deferred, unless the Deferred was cancelled
+def fire(d, future):
+    if d.called or future.cancelled():
+        return
+    if future.exception() is not None:
+        d.errback(failure.Failure(future.exception()))
+    else:
+        d.callback(future.result())
+
+
+def run(ledger, my_address, signing_key, port, peer_port, network_settings, bootstrap_address=None, console=True):
+    """ Run a node until the console closes, returns the factory so the caller can save its ledger """
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    factory = AsyncioNodeFactory(Reactor(loop), ledger, my_address, signing_key, peer_port, "myIP", network_settings)
+
+    server = loop.run_until_complete(listen(loop, port, factory))
+    loop.call_later(5, factory.startPOW)
+    loop.create_task(ping_peers(factory, network_settings.PING_INTERVAL))
+    if console:
+        command_protocol = factory.buildCommandProtocol()
+        command_protocol.makeConnection(ConsoleTransport(command_protocol))
+        loop.run_until_complete(loop.connect_read_pipe(lambda: ConsoleInput(command_protocol), sys.stdin))
+    if bootstrap_address is not None:
+        factory.reactor.connectTCP(bootstrap_address, peer_port, factory)
+
+    try:
+        loop.run_forever()
+    finally:
+        factory.miner.stop()
+        server.close()
+    return factory
@@ -0,0 +1,77 @@
+"""
+
+Benchmark of the memory a chain held in memory takes
+
+"python benchmark_memory.py" builds a chain of blocks of signed transactions
+between a few hundred keys and reports the memory per transaction with every
+block kept as objects and packed into columns (see packed.py), the form
+blockstore.StoredBlocks keeps older blocks in, and the time a packed block takes
+to unpack.
+
+"""
+
+import gc
+import hashlib
+import time
+import tracemalloc
+import nacl.encoding
+import nacl.signing
+from coin import Block, Transaction, COIN
+import helper
+import packed
+
+BLOCKS = 50
+TRANSACTIONS = 1000
+KEYS = 300
+
+def make_chain():
+    signing_keys = [nacl.signing.SigningKey(hashlib.sha256(str(number).encode("ascii")).digest()) for number in range(KEYS)]
+    addresses = [signing_key.verify_key.encode(encoder=nacl.encoding.HexEncoder) for signing_key in signing_keys]
+    blocks = []
+    prev_hash = hashlib.sha256(b"previous").hexdigest()
+    for height in range(1, BLOCKS + 1):
+        transactions = []
+        for number in range(TRANSACTIONS):
+            sender = (height * TRANSACTIONS + number) % KEYS
+            input_hash = hashlib.sha256(str((height, number)).encode("ascii")).hexdigest()
+            transaction = Transaction([input_hash], COIN // 2, addresses[sender], addresses[(sender + 1) % KEYS])
+            transaction.sign(signing_keys[sender].sign(transaction.signed_bytes(), encoder=nacl.encoding.HexEncoder).signature)
+            transactions.append(transaction)
+        block = Block(transactions, addresses[0], prev_hash, height)
+        helper.label_transactions(block, height)
+        block.set_block_number(height)
+        block.set_hash()
+        blocks.append(block)
+        prev_hash = block.hash
+    return blocks
+
+#Memory taken by what build returns, in bytes per transaction
+def measure(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(*args)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size / (BLOCKS * TRANSACTIONS)
+
+if __name__ == "__main__":
+    blocks = make_chain()
+    dumps = [block.dump() for block in blocks]
+    objects = measure(lambda: [Block.from_json(dump) for dump in dumps])
+    columns = measure(lambda: [packed.PackedBlock(Block.from_json(dump)) for dump in dumps])
+    print(str(BLOCKS * TRANSACTIONS) + " transactions: objects " + "%.0f" % objects + " bytes each, "
+        + "packed " + "%.0f" % columns + " bytes each, " + "%.1fx smaller" % (objects / columns))
+    print("per million transactions: objects " + "%.0f MB" % objects + ", packed " + "%.0f MB" % columns)
+
+    packed_block = packed.PackedBlock(blocks[0])
+    assert [transaction.hash for transaction in packed_block.unpack().transactions] == [transaction.hash for transaction in blocks[0].transactions]
+    start_time = time.perf_counter()
+    Block.from_json(dumps[0])
+    loaded = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    packed_block.unpack()
+    unpacked = time.perf_counter() - start_time
+    print("block of " + str(TRANSACTIONS) + " transactions: from JSON " + "%.1f ms" % (loaded * 1000) + ", unpacked " + "%.1f ms" % (unpacked * 1000))
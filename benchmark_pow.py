@@ -0,0 +1,45 @@
+"""
+
+Microbenchmark of the proof of work hash loop
+
+"python benchmark_pow.py" compares hashes per second of the original string
+based loop against POW.search_range at difficulties 4 to 6
+
+"""
+
+import hashlib
+import time
+import POW
+
+NONCES = 300000
+
+#The loop find_nonce used before the midstate search, kept here as the baseline
+def string_loop(hash_value, POW_difficulty, start, count):
+    target = ""
+    for _ in range(POW_difficulty):
+        target = target + "0"
+    for nonce in range(start, start + count):
+        result = hashlib.sha256((hash_value+str(nonce)).encode('utf-8')).hexdigest()
+        if result[:POW_difficulty] == target:
+            return nonce
+    return None
+
+def hashes_per_second(search, hash_value, POW_difficulty):
+    """ Run search over NONCES nonces, resuming after every hit """
+    nonce = 1000000
+    end = nonce + NONCES
+    start_time = time.perf_counter()
+    while nonce < end:
+        found = search(hash_value, POW_difficulty, nonce, end - nonce)
+        if found is None:
+            break
+        nonce = found + 1
+    return NONCES / (time.perf_counter() - start_time)
+
+if __name__ == "__main__":
+    hash_value = hashlib.sha256(b"benchmark").hexdigest()
+    for POW_difficulty in (4, 5, 6):
+        baseline = hashes_per_second(string_loop, hash_value, POW_difficulty)
+        midstate = hashes_per_second(POW.search_range, hash_value, POW_difficulty)
+        print("difficulty " + str(POW_difficulty) + ": string loop " + str(int(baseline)) + " H/s, midstate "
+            + str(int(midstate)) + " H/s, " + "%.2fx" % (midstate / baseline))
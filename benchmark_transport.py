@@ -0,0 +1,113 @@
+"""
+
+Benchmark of the Twisted and asyncio node runtimes
+
+"python benchmark_transport.py" connects two nodes over loopback on each runtime
+and sends pings with a fixed number outstanding, reporting messages per second
+and the round trip time percentiles of the pings. uvloop is used for the asyncio
+runs when it is installed.
+
+"""
+
+import time
+import asyncio
+import nacl.encoding
+import nacl.signing
+from coin import Block, Transaction, Ledger, COIN
+import helper
+import network_settings as ns
+import node
+import asyncio_node
+
+COUNT = 20000
+WINDOW = 50
+
+#Seconds allowed for the nodes to exchange versions before pinging
+SETTLE_TIME = 0.5
+
+def make_ledger():
+    address = nacl.signing.SigningKey(b"g" * 32).verify_key.encode(encoder=nacl.encoding.HexEncoder)
+    block = Block([Transaction("0", COIN, -1, address)], 0, 0, 0)
+    helper.label_transactions(block, 0)
+    block.set_block_number(0)
+    block.set_hash()
+    return Ledger([block])
+
+def make_factory(factory_class, reactor):
+    signing_key = nacl.signing.SigningKey(b"k" * 32)
+    address = signing_key.verify_key.encode(encoder=nacl.encoding.HexEncoder)
+    return factory_class(reactor, make_ledger(), address, signing_key, 0, "benchmark", ns)
+
+class PingDriver:
+    """ Keeps WINDOW pings outstanding on a peer connection until COUNT pongs came back """
+
+    def __init__ (self, protocol, done):
+        self.protocol = protocol
+        self.done = done
+        self.sent_times = []
+        self.latencies = []
+        protocol.do_pong = self.pong
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        for _ in range(WINDOW):
+            self.send()
+
+    def send(self):
+        if len(self.sent_times) < COUNT:
+            self.sent_times.append(time.perf_counter())
+            self.protocol.sendData("ping", "")
+
+    def pong(self, data):
+        now = time.perf_counter()
+        self.latencies.append(now - self.sent_times[len(self.latencies)])
+        if len(self.latencies) == COUNT:
+            self.elapsed = now - self.start_time
+            self.done()
+        else:
+            self.send()
+
+    def report(self, name):
+        latencies = sorted(self.latencies)
+        percentile = lambda fraction: latencies[min(int(fraction * len(latencies)), len(latencies) - 1)] * 1000
+        print(name + ": " + "%.0f messages/s" % (2 * COUNT / self.elapsed)
+            + ", round trip p50 " + "%.2f ms" % percentile(0.5) + " p99 " + "%.2f ms" % percentile(0.99)
+            + " p99.9 " + "%.2f ms" % percentile(0.999))
+
+def run_twisted():
+    from twisted.internet import reactor
+    server = make_factory(node.NodeFactory, reactor)
+    client = make_factory(node.NodeFactory, reactor)
+    port = reactor.listenTCP(0, server, interface="127.0.0.1")
+    reactor.connectTCP("127.0.0.1", port.getHost().port, client)
+
+    drivers = []
+    def start():
+        drivers.append(PingDriver(next(iter(client.peers.values())), reactor.stop))
+        drivers[0].start()
+    reactor.callLater(SETTLE_TIME, start)
+    reactor.run()
+    return drivers[0]
+
+def run_asyncio():
+    loop = asyncio_node.new_event_loop()
+    asyncio.set_event_loop(loop)
+    reactor = asyncio_node.Reactor(loop)
+    server = make_factory(asyncio_node.AsyncioNodeFactory, reactor)
+    client = make_factory(asyncio_node.AsyncioNodeFactory, reactor)
+    listener = loop.run_until_complete(loop.create_server(lambda: asyncio_node.PeerConnection(server, loop), "127.0.0.1", 0))
+    reactor.connectTCP("127.0.0.1", listener.sockets[0].getsockname()[1], client)
+
+    drivers = []
+    def start():
+        drivers.append(PingDriver(next(iter(client.peers.values())), loop.stop))
+        drivers[0].start()
+    loop.call_later(SETTLE_TIME, start)
+    loop.run_forever()
+    listener.close()
+    return drivers[0]
+
+if __name__ == "__main__":
+    print(str(COUNT) + " pings, " + str(WINDOW) + " outstanding")
+    run_asyncio().report(type(asyncio.get_event_loop()).__module__.split(".")[0])
+    run_twisted().report("twisted")
@@ -0,0 +1,98 @@
+"""
+
+Benchmark of block validation throughput
+
+"python benchmark_validation.py" builds a ledger with an unspent output for each
+of a block's transactions and times the steps a block goes through once its
+signatures are known to be good: checking balances with valid_block, building
+a block with process_block, labeling and hashing, and the JSON round trip.
+
+The balance steps are also timed with amounts held as Decimal coins, the way
+they were held before base units, and both numbers are printed side by side.
+
+"""
+
+import copy
+import hashlib
+import time
+from decimal import Decimal
+import nacl.encoding
+import nacl.signing
+from coin import Block, Transaction, Ledger, COIN
+import helper
+
+TRANSACTIONS = 2000
+REPEAT = 5
+KEYS = 50
+
+def make_ledger_and_block():
+    signing_keys = [nacl.signing.SigningKey(hashlib.sha256(str(number).encode("ascii")).digest()) for number in range(KEYS)]
+    addresses = [signing_key.verify_key.encode(encoder=nacl.encoding.HexEncoder) for signing_key in signing_keys]
+
+    #One output of a coin for each transaction of the block
+    outputs = [Transaction("0", COIN, -1, addresses[number % KEYS]) for number in range(TRANSACTIONS)]
+    genesis_block = Block(outputs, 0, 0, 0)
+    for number, output in enumerate(outputs):
+        output.set_block(0)
+        output.set_number(number)
+        output.set_hash()
+    genesis_block.set_block_number(0)
+    genesis_block.set_hash()
+    ledger = Ledger([genesis_block])
+
+    transactions = []
+    for number, output in enumerate(outputs):
+        transaction = Transaction([output.hash], COIN // 2, output.receiver, addresses[(number + 1) % KEYS])
+        transaction.sign(signing_keys[number % KEYS].sign(transaction.signed_bytes(), encoder=nacl.encoding.HexEncoder).signature)
+        transactions.append(transaction)
+    return ledger, transactions
+
+#Amounts as the Decimal coins they were held as before base units, kept here as the baseline
+def decimal_copy(transaction):
+    baseline = copy.copy(transaction)
+    baseline.value = Decimal(transaction.value) / COIN
+    #The signed encoding stays the one made from the base units, so signatures are still found in the cache
+    baseline.body_fields = baseline.signed_fields()
+    return baseline
+
+def decimal_ledger_and_block(ledger, block):
+    genesis_block = copy.copy(ledger.blocks[0])
+    genesis_block.transactions = [decimal_copy(transaction) for transaction in genesis_block.transactions]
+    decimal_block = copy.copy(block)
+    decimal_block.transactions = [decimal_copy(transaction) for transaction in block.transactions]
+    return Ledger([genesis_block]), decimal_block
+
+def best_time(function):
+    times = []
+    for _ in range(REPEAT):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+if __name__ == "__main__":
+    ledger, transactions = make_ledger_and_block()
+    block = Block(list(transactions), ledger.blocks[0].hash, ledger.current_block_hash(), 0)
+    #Signatures are checked once here, the steps below find them in the cache
+    helper.process_block(block, ledger)
+
+    decimal_ledger, decimal_block = decimal_ledger_and_block(ledger, block)
+    assert helper.valid_block(decimal_block, decimal_ledger, verified=True)
+    assert len(helper.process_block(decimal_block, decimal_ledger)) == len(helper.process_block(block, ledger))
+
+    balance_steps = [
+        ("valid_block", lambda ledger, block: helper.valid_block(block, ledger, verified=True)),
+        ("process_block", lambda ledger, block: helper.process_block(block, ledger)),
+    ]
+    for name, step in balance_steps:
+        baseline = TRANSACTIONS / best_time(lambda: step(decimal_ledger, decimal_block))
+        integer = TRANSACTIONS / best_time(lambda: step(ledger, block))
+        print(name + ": Decimal " + "%.0f transactions/s" % baseline + ", base units " + "%.0f transactions/s" % integer
+            + ", " + "%.2fx" % (integer / baseline))
+
+    steps = [
+        ("label and hash", lambda: (helper.label_transactions(block, 1), block.set_hash())),
+        ("dump and load", lambda: Block.from_json(block.dump())),
+    ]
+    for name, step in steps:
+        print(name + ": " + "%.0f transactions/s" % (TRANSACTIONS / best_time(step)))
@@ -0,0 +1,51 @@
+"""
+
+Benchmark of the peer message encodings
+
+"python benchmark_wire.py" builds blocks of signed transactions and compares the
+size and parse time of a newBlock message as a JSON line and as a binary frame
+
+"""
+
+import time
+import hashlib
+import nacl.encoding
+import nacl.signing
+from coin import Block, Transaction, COIN
+import helper
+import wire
+
+REPEAT = 50
+
+def make_block(count):
+    signing_key = nacl.signing.SigningKey(b"b" * 32)
+    sender = signing_key.verify_key.encode(encoder=nacl.encoding.HexEncoder)
+    receiver = nacl.signing.SigningKey(b"r" * 32).verify_key.encode(encoder=nacl.encoding.HexEncoder)
+    transactions = []
+    for number in range(count):
+        input_hash = hashlib.sha256(str(number).encode("ascii")).hexdigest()
+        transaction = Transaction([input_hash], COIN // 2, sender, receiver)
+        transaction.sign(signing_key.sign(transaction.signed_bytes(), encoder=nacl.encoding.HexEncoder).signature)
+        transactions.append(transaction)
+    block = Block(transactions, sender, hashlib.sha256(b"previous").hexdigest(), 123456789)
+    helper.label_transactions(block, 1)
+    block.set_block_number(1)
+    block.set_hash()
+    return block
+
+def parse_time(decode, message):
+    start_time = time.perf_counter()
+    for _ in range(REPEAT):
+        decode(message)
+    return (time.perf_counter() - start_time) / REPEAT
+
+if __name__ == "__main__":
+    for count in (10, 100, 1000):
+        block = make_block(count)
+        line = wire.encode_line("newBlock", block)
+        frame = wire.encode_frame("newBlock", block)
+        line_time = parse_time(wire.decode_line, line)
+        frame_time = parse_time(wire.decode_frame, frame[wire.COUNT.size:])
+        print(str(count) + " transactions: JSON " + str(len(line)) + " bytes " + "%.2f ms" % (line_time * 1000)
+            + ", binary " + str(len(frame)) + " bytes " + "%.2f ms" % (frame_time * 1000)
+            + ", " + "%.0f%% of the bytes" % (100.0 * len(frame) / len(line)))
@@ -0,0 +1,604 @@
+"""
+
+Append-only on-disk storage for the blocks of a ledger
+
+Blocks are appended to segment files blocks00000.dat, blocks00001.dat, ... as they
+are accepted. index.dat holds one fixed size record per height with the segment,
+offset, length and hash of the block, and chainstate.p holds the ledger indexes
+for the tip they were saved at. Each block is followed in its segment by the
+payload of its binary frame (see wire.py) and by its undo record, the outputs it
+spent with the value left in them and the outputs it created. binary.dat and
+undo.dat hold the segment, offset and length of those records for each height, so
+blocks are served to binary peers as they are on disk and disconnected without
+replaying the chain. Opening a store only reads index.dat, the
+chainstate and the tip block, older blocks are loaded when they are asked for.
+Reads go through read only memory maps of the segments, so a stored block can be
+sent to a peer as a slice of the map without building Block objects. Loaded
+blocks are cached as objects, and the ones pushed out of that cache are kept a
+while longer packed into columns (see packed.py).
+
+A pruned store (see PrunedBlocks) deletes the segments that only hold blocks
+under a window of recent ones, once a chainstate saved on a worker thread covers
+them. index.dat keeps the hash of every block, so the chain of hashes is still
+known and served to peers.
+
+"""
+
+import os
+import mmap
+import json
+import pickle
+import shutil
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import coin
+import wire
+import packed
+import snapshot
+
+#Segment files are started once the current one passes this size
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+#Smaller segments for pruned stores, blocks are deleted a segment at a time
+PRUNED_SEGMENT_SIZE = 4 * 1024 * 1024
+
+#Blocks that leave the window of a pruned store before it is pruned again
+PRUNE_STEP = 10
+
+#Number of loaded blocks kept in memory
+CACHE_SIZE = 256
+
+#Blocks pushed out of the cache that are kept packed into columns (see packed.py), about as much memory as the cache, 0 keeps none
+PACKED_CACHE_SIZE = 1024
+
+#Format of chainstate.p, version 2 holds amounts in base units, older states are rebuilt by replaying the chain
+STATE_VERSION = 2
+
+#Writes the chainstate of pruned stores, one save at a time
+state_writer = ThreadPoolExecutor(1)
+
+#segment number, offset, length, block hash
+INDEX_RECORD = struct.Struct(">IQI64s")
+
+#segment number, offset, length of a record kept next to a block, a length of 0 for blocks stored without one
+SIDE_RECORD = struct.Struct(">IQI")
+
+#Index of a kind of record kept next to each stored block, one location per height
+class RecordIndex:
+    def __init__ (self, path, heights):
+        """ Records past heights, the number of blocks indexed, are dropped """
+        with open(path, "ab+") as index_file:
+            index_file.seek(0)
+            data = index_file.read()
+        usable = min(len(data) - len(data) % SIDE_RECORD.size, heights * SIDE_RECORD.size)
+        if usable != len(data):
+            os.truncate(path, usable)
+        self.locations = list(SIDE_RECORD.iter_unpack(data[:usable]))
+        self.file = open(path, "r+b")
+
+    def __len__(self):
+        return len(self.locations)
+
+    def get(self, height):
+        """ Return (segment, offset, length) of the record at height, None if the block was stored without one """
+        if height >= len(self.locations) or self.locations[height][2] == 0:
+            return None
+        return self.locations[height]
+
+    #End of the records written to a segment, records filled in later can be past the one of the newest block
+    def end(self, segment):
+        return max([offset + length + 1 for record_segment, offset, length in self.locations if record_segment == segment and length > 0] + [0])
+
+    def set(self, height, location):
+        """ Index the record at height, heights under it without one are marked as having none """
+        while len(self.locations) <= height:
+            self.locations.append((0, 0, 0))
+            self.file.seek((len(self.locations) - 1) * SIDE_RECORD.size)
+            self.file.write(SIDE_RECORD.pack(0, 0, 0))
+        self.locations[height] = location
+        self.file.seek(height * SIDE_RECORD.size)
+        self.file.write(SIDE_RECORD.pack(*location))
+        self.file.flush()
+
+    def truncate(self, height):
+        if height < len(self.locations):
+            self.file.truncate(height * SIDE_RECORD.size)
+            del self.locations[height:]
+
+    def close(self):
+        self.file.close()
+
+
+class BlockStore:
+    def __init__ (self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.locations = []
+        self.hashes = []
+        self.maps = {}
+        #Save started by save_state_later that has not been waited for, and the indexes it froze
+        self.saving = None
+        self.frozen = ()
+
+        index_path = os.path.join(directory, "index.dat")
+        with open(index_path, "ab+") as index_file:
+            index_file.seek(0)
+            data = index_file.read()
+
+        #Drop a record left half written by a crash
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        if usable != len(data):
+            os.truncate(index_path, usable)
+        for segment, offset, length, block_hash in INDEX_RECORD.iter_unpack(data[:usable]):
+            self.locations.append((segment, offset, length))
+            self.hashes.append(block_hash.decode("ascii"))
+
+        #Records of blocks that are no longer indexed are dropped as well
+        self.binary = RecordIndex(os.path.join(directory, "binary.dat"), len(self.locations))
+        self.undo = RecordIndex(os.path.join(directory, "undo.dat"), len(self.locations))
+
+        #Drop data written after the last indexed block and its records
+        if len(self.locations) > 0:
+            records = [location for location in self.binary.locations + self.undo.locations if location[2] > 0]
+            self.segment = max([self.locations[-1][0]] + [location[0] for location in records])
+            end = max(self.binary.end(self.segment), self.undo.end(self.segment))
+            if self.locations[-1][0] == self.segment:
+                end = max(end, self.locations[-1][1] + self.locations[-1][2] + 1)
+            os.truncate(self.segment_path(self.segment), end)
+        else:
+            self.segment = 0
+        self.index_file = open(index_path, "ab")
+        self.segment_file = open(self.segment_path(self.segment), "ab")
+
+        #Segments under this one were deleted by prune
+        self.first_segment = 0
+        while self.first_segment < self.segment and not os.path.exists(self.segment_path(self.first_segment)):
+            self.first_segment = self.first_segment + 1
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, "blocks%05d.dat" % segment)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def append(self, block):
+        """ Write a block at the next height, followed by the payload of its binary frame """
+        record = encode_block(block)
+        offset = self.write(record)
+        segment = self.segment
+        payload = bytearray()
+        wire.encode_block(block, payload)
+        payload_offset = self.write(payload)
+        self.index_file.write(INDEX_RECORD.pack(segment, offset, len(record), block.hash.encode("ascii")))
+        self.index_file.flush()
+        self.locations.append((segment, offset, len(record)))
+        self.hashes.append(block.hash)
+        self.binary.set(len(self.locations) - 1, (self.segment, payload_offset, len(payload)))
+
+    def append_undo(self, height, journal):
+        """ Write the undo journal of the stored block at height, a block that already has its record is left as it is """
+        if self.undo.get(height) is not None or height >= len(self.locations):
+            return
+        record = encode_undo(journal)
+        offset = self.write(record)
+        self.undo.set(height, (self.segment, offset, len(record)))
+
+    def read_undo(self, height):
+        """ Return the undo journal of the block at height, None if it was stored without one or has been pruned """
+        location = self.undo.get(height)
+        if location is None or location[0] < self.first_segment:
+            return None
+        return decode_undo(self.read_bytes(*location))
+
+    def read_payload(self, height):
+        """ Return the binary frame payload of the block at height as a memoryview of the segment map, None if it was stored without one """
+        location = self.binary.get(height)
+        if location is None:
+            return None
+        if location[0] < self.first_segment:
+            raise IndexError("block " + str(height) + " has been pruned")
+        return self.read_bytes(*location)
+
+    #Write a record to the end of the current segment, starting the next one once it is full, returns its offset
+    def write(self, record):
+        if self.segment_file.tell() + len(record) > self.segment_size and self.segment_file.tell() > 0:
+            self.segment_file.close()
+            self.segment = self.segment + 1
+            self.segment_file = open(self.segment_path(self.segment), "ab")
+
+        offset = self.segment_file.tell()
+        self.segment_file.write(record + b"\n")
+        self.segment_file.flush()
+        return offset
+
+    def read_record(self, height):
+        """ Return the stored bytes of the block at height as a memoryview of the segment map """
+        segment, offset, length = self.locations[height]
+        if segment < self.first_segment:
+            raise IndexError("block " + str(height) + " has been pruned")
+        return self.read_bytes(segment, offset, length)
+
+    def read_bytes(self, segment, offset, length):
+        segment_map = self.maps.get(segment)
+
+        #The current segment grows, map it again once it has passed the old map
+        if segment_map is None or len(segment_map) < offset + length:
+            with open(self.segment_path(segment), "rb") as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return memoryview(segment_map)[offset:offset + length]
+
+    def read(self, height):
+        return decode_block(self.read_record(height))
+
+    def truncate(self, height):
+        """ Remove the blocks at height and above, used when the ledger switches branch
+
+        Only the index is cut, the block data stays where it is until the store is
+        next opened so memory views handed out earlier stay valid.
+        """
+        if height >= len(self.locations):
+            return
+        self.index_file.truncate(height * INDEX_RECORD.size)
+        del self.locations[height:]
+        del self.hashes[height:]
+        self.binary.truncate(height)
+        self.undo.truncate(height)
+
+    def prune(self, height):
+        """ Delete the segments that only hold blocks under height and their undo records, their hashes stay in the index """
+        if height >= len(self.locations):
+            return
+        while self.first_segment < self.locations[height][0]:
+            path = self.segment_path(self.first_segment)
+            if os.path.exists(path):
+                os.remove(path)
+            self.maps.pop(self.first_segment, None)
+            self.first_segment = self.first_segment + 1
+
+    def pruned(self):
+        """ True if blocks of the store have been deleted """
+        return len(self.locations) > 0 and self.locations[0][0] < self.first_segment
+
+    def save_state(self, ledger):
+        """ Save the ledger indexes so the next start does not replay the chain """
+        self.saved(True)
+        self.write_state(self.state(ledger, ledger.index_state()))
+
+    def save_state_later(self, ledger):
+        """ Save the ledger indexes on a worker thread, False if the last save is still being written
+
+        The unspent set and the address balances are frozen as they are and written
+        without being copied, the ledger goes on changing on top of them until
+        saved() finds the save written.
+        """
+        if not self.saved():
+            return False
+        state = {"utxo": ledger.utxo.freeze(), "addresses": ledger.addresses.freeze(), "heights": dict(ledger.heights)}
+        self.frozen = (ledger.utxo, ledger.addresses)
+        self.saving = state_writer.submit(self.write_state, self.state(ledger, state))
+        return True
+
+    def saved(self, wait=False):
+        """ True once the save started by save_state_later is written, or waits for it, raises what it failed with """
+        if self.saving is not None:
+            if not wait and not self.saving.done():
+                return False
+            saving = self.saving
+            self.saving = None
+            for index in self.frozen:
+                index.thaw()
+            self.frozen = ()
+            saving.result()
+        return True
+
+    def state(self, ledger, state):
+        if isinstance(ledger.blocks, PrunedBlocks):
+            state["pruned"] = ledger.blocks.prune_state()
+        state["tip"] = self.hashes[-1]
+        state["version"] = STATE_VERSION
+        return state
+
+    def write_state(self, state):
+        state_path = os.path.join(self.directory, "chainstate.p")
+        with open(state_path + ".tmp", "wb") as state_file:
+            pickle.dump(state, state_file)
+        os.replace(state_path + ".tmp", state_path)
+
+    def load_state(self):
+        """ Return the saved ledger indexes, None if they are missing, in an older format or of a block no longer stored
+
+        state["height"] is the height of the block they were saved at, the blocks
+        stored after it are indexed on top of them when the ledger is opened.
+        """
+        state_path = os.path.join(self.directory, "chainstate.p")
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path, "rb") as state_file:
+            state = pickle.load(state_file)
+        if state.pop("version", 1) != STATE_VERSION:
+            return None
+        tip = state.pop("tip")
+        for height in reversed(range(len(self.hashes))):
+            if self.hashes[height] == tip:
+                state["height"] = height
+                return state
+        return None
+
+    def close(self):
+        self.saved(True)
+        self.segment_file.close()
+        self.index_file.close()
+        self.binary.close()
+        self.undo.close()
+        self.maps = {}
+
+
+#Records hold the block's dump() as a JSON string, the form it takes inside a getBlock message
+def encode_block(block):
+    return json.dumps(block.dump()).encode("ascii")
+
+def decode_block(record):
+    return coin.Block.from_json(json.loads(str(record, "ascii")))
+
+#Undo records hold the journal UnspentSet.apply_block returned, each change is the transaction hash and
+#a flag, followed for a spent output by the transaction in its wire encoding and the value left in it
+def encode_undo(journal):
+    out = bytearray(wire.COUNT.pack(len(journal)))
+    for transaction_hash, previous in journal:
+        wire.encode_value(transaction_hash, out)
+        if previous is None:
+            out.append(0)
+        else:
+            out.append(1)
+            wire.encode_transaction(previous[0], out)
+            out += wire.INTEGER.pack(previous[1])
+    return bytes(out)
+
+def decode_undo(record):
+    journal = []
+    position = wire.COUNT.size
+    for _ in range(wire.COUNT.unpack_from(record, 0)[0]):
+        transaction_hash, position = wire.decode_value(record, position)
+        previous = None
+        if record[position] == 1:
+            transaction, position = wire.decode_transaction(record, position + 1)
+            previous = (transaction, wire.INTEGER.unpack_from(record, position)[0])
+            position = position + wire.INTEGER.size
+        else:
+            position = position + 1
+        journal.append((transaction_hash, previous))
+    return journal
+
+
+#Block in the store that has not been loaded
+class BlockView:
+    def __init__ (self, store, height):
+        self.store = store
+        self.block_number = height
+        self.hash = store.hashes[height]
+
+    #Stored bytes of the block, see encode_block
+    def record(self):
+        return self.store.read_record(self.block_number)
+
+    #Stored payload of the block's binary frame, None if it was stored without one
+    def payload(self):
+        return self.store.read_payload(self.block_number)
+
+    def load(self):
+        return decode_block(self.record())
+
+
+#List-like view of a BlockStore that Ledger uses in place of a list of blocks
+class StoredBlocks:
+    def __init__ (self, store):
+        self.store = store
+        self.cache = OrderedDict()
+        self.packed = OrderedDict()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[index] for index in range(*height.indices(len(self)))]
+        if height < 0:
+            height = height + len(self)
+        if height < 0 or height >= len(self):
+            raise IndexError("block height out of range")
+
+        block = self.cache.get(height)
+        if block is None:
+            packed_block = self.packed.get(height)
+            if packed_block is not None:
+                self.packed.move_to_end(height)
+                block = packed_block.unpack()
+            else:
+                block = self.view(height).load()
+            self.remember(height, block)
+        else:
+            self.cache.move_to_end(height)
+        return block
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def view(self, height):
+        return BlockView(self.store, height)
+
+    def block_hash(self, height):
+        return self.store.hashes[height]
+
+    def __delitem__(self, heights):
+        """ Only removing the top of the chain is supported, as in del blocks[height:] """
+        if not isinstance(heights, slice) or heights.stop is not None or heights.step is not None:
+            raise TypeError("only del blocks[height:] is supported")
+        height = heights.indices(len(self))[0]
+        self.store.truncate(height)
+        self.forget_cached(lambda cached_height: cached_height >= height)
+
+    def append(self, block):
+        self.store.append(block)
+        self.remember(len(self) - 1, block)
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def remember(self, height, block):
+        self.cache[height] = block
+        self.cache.move_to_end(height)
+        if len(self.cache) > CACHE_SIZE:
+            old_height, old_block = self.cache.popitem(last=False)
+            if PACKED_CACHE_SIZE > 0 and old_height not in self.packed:
+                self.packed[old_height] = packed.PackedBlock(old_block)
+                if len(self.packed) > PACKED_CACHE_SIZE:
+                    self.packed.popitem(last=False)
+
+    #Drop the cached blocks at the heights dropped returns True for
+    def forget_cached(self, dropped):
+        for cache in (self.cache, self.packed):
+            for cached_height in [cached_height for cached_height in cache if dropped(cached_height)]:
+                del cache[cached_height]
+
+
+#StoredBlocks of a pruned node, only a window of recent blocks is kept in full
+class PrunedBlocks(StoredBlocks):
+    def __init__ (self, store, window, base):
+        """ base is the oldest block kept for reorgs, the blocks above it are disconnected with their undo records """
+        StoredBlocks.__init__(self, store)
+        self.window = window
+        self.base = base
+        #Base whose segments are deleted once the state saved for it is written
+        self.pending = None
+        #hash -> height of the blocks under base, the ledger only indexes the ones above
+        self.pruned_heights = {store.hashes[height]: height for height in range(base)}
+
+    #Blocks from base up
+    def __iter__(self):
+        for height in range(self.base, len(self)):
+            yield self[height]
+
+    def unspent(self):
+        raise ValueError("a pruned ledger can only disconnect blocks with their undo records")
+
+    def pruned_height(self, block_hash):
+        """ Height of a block under base, None if it is not one """
+        return self.pruned_heights.get(block_hash)
+
+    def prune(self, ledger):
+        """ Move base up to the bottom of the window and delete what is under it, called once ledger has indexed a new block
+
+        The ledger indexes are saved on a worker thread first, the next start needs
+        them since the blocks they were built from are gone. Segments are deleted
+        on a later call, after the save is written.
+        """
+        if self.pending is not None and self.store.saved():
+            self.store.prune(self.pending)
+            self.pending = None
+        base = len(self) - 1 - self.window
+        if base - self.base < PRUNE_STEP or self.pending is not None or not self.store.saved():
+            return
+        self.forget(ledger, base)
+        self.store.save_state_later(ledger)
+        self.pending = base
+
+    #Move base up, dropping the heights and address locations of the blocks under it
+    def forget(self, ledger, base):
+        for height in range(self.base, base):
+            ledger.heights.pop(self.store.hashes[height], None)
+            self.pruned_heights[self.store.hashes[height]] = height
+        ledger.addresses.prune(base)
+        self.base = base
+        self.forget_cached(lambda cached_height: cached_height < base)
+
+    def prune_state(self):
+        return [self.window, self.base]
+
+
+def open_ledger(directory, legacy_path=None, snapshot_path=None, prune=None):
+    """ Open the ledger stored in directory
+
+    A store that is still empty is filled from the pickled ledger at legacy_path,
+    the format genesis.py writes and older nodes saved, or is started from the UTXO
+    snapshot at snapshot_path when that file exists (see snapshot.py). A ledger
+    started from a snapshot keeps it in directory until its history is checked,
+    and opens from it again.
+
+    prune is the number of recent blocks a pruned node keeps in full, a store that
+    has been pruned stays pruned.
+    """
+    store = BlockStore(directory, SEGMENT_SIZE if prune is None else PRUNED_SEGMENT_SIZE)
+    pending = os.path.join(directory, snapshot.PENDING_FILE)
+    if os.path.exists(pending):
+        #The history can have been checked past the snapshot before the node stopped
+        if len(store) <= snapshot.read_header(pending)["height"]:
+            return open_snapshot(store, pending)
+        os.remove(pending)
+    elif len(store) == 0 and snapshot_path is not None:
+        if os.path.exists(snapshot_path):
+            return open_snapshot(store, snapshot_path)
+        print("no snapshot at " + snapshot_path + ", opening " + str(legacy_path))
+
+    if len(store) == 0:
+        with open(legacy_path, "rb") as legacy_file:
+            legacy_ledger = pickle.load(legacy_file)
+        for block in legacy_ledger.blocks:
+            store.append(block)
+        store.save_state(legacy_ledger)
+
+    blocks = StoredBlocks(store)
+    state = store.load_state()
+    pruned = None
+    if state is None:
+        if store.pruned():
+            raise ValueError("the pruned store in " + directory + " has no usable chainstate, start it again from a snapshot")
+        print("replaying stored chain to rebuild indexes")
+    else:
+        pruned = state.pop("pruned", None)
+    ledger = coin.Ledger(blocks, state)
+
+    if pruned is not None:
+        window, base = pruned
+        ledger.blocks = PrunedBlocks(store, window if prune is None else prune, base)
+        ledger.blocks.forget(ledger, base)
+        #The state was saved before the segments under base were deleted
+        store.prune(base)
+    elif prune is not None:
+        #Pruning a full store, the blocks above its window have their undo records already
+        base = max(len(store) - 1 - prune, 0)
+        ledger.blocks = PrunedBlocks(store, prune, 0)
+        ledger.blocks.forget(ledger, base)
+        store.save_state(ledger)
+        store.prune(base)
+    if isinstance(ledger.blocks, PrunedBlocks):
+        ledger.blocks.prune(ledger)
+    return ledger
+
+def open_snapshot(store, path):
+    """ Start a ledger from the snapshot at path, the store holds the blocks under it checked so far """
+    started = snapshot.read_snapshot(path)
+    if len(store) == 0:
+        store.append(started.genesis)
+    elif store.hashes[0] != started.genesis.hash:
+        raise ValueError("the snapshot is of another chain than the stored blocks")
+    pending = os.path.join(store.directory, snapshot.PENDING_FILE)
+    if os.path.abspath(path) != os.path.abspath(pending):
+        shutil.copyfile(path, pending)
+    history = coin.Ledger(StoredBlocks(store), store.load_state())
+    print("started from snapshot at block " + str(started.height) + ", " + str(len(store)) + " blocks of history checked")
+    return started.ledger(history)
+
+def save_ledger(ledger, legacy_path):
+    """ Save a ledger, blocks of a stored ledger are already on disk so only its indexes are written """
+    if isinstance(ledger.blocks, StoredBlocks):
+        ledger.blocks.store.save_state(ledger)
+    elif isinstance(ledger.blocks, snapshot.SnapshotBlocks):
+        ledger.blocks.save(ledger)
+    else:
+        with open(legacy_path, "wb") as legacy_file:
+            pickle.dump(ledger, legacy_file)
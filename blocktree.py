@@ -0,0 +1,71 @@
+"""
+
+Blocks of the branches competing with the chain
+
+A ledger holds the branch with the most work as its chain. Blocks of the other
+branches are kept in a BlockTree keyed by hash, with the height they are at and
+the cumulative work of the branch they end. When a branch gets more work than
+the tip the ledger switches to it (see Ledger.reorganize): the blocks above the
+fork are disconnected by undoing their unspent set journals and kept here in turn,
+and the blocks of the branch are connected, so a reorg costs the depth of the
+fork instead of a pass over the chain.
+
+"""
+
+#Branches forking further down than this under the tip are dropped, and undo journals are kept this deep
+MAX_DEPTH = 100
+
+class BlockTree:
+    def __init__ (self):
+        #block hash -> (block, height, cumulative work)
+        self.nodes = {}
+        #parent hash -> hashes of the blocks built on it
+        self.children = {}
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.nodes
+
+    def get(self, block_hash):
+        """ Return (block, height, cumulative work) of a block of the tree, None if it is not in it """
+        return self.nodes.get(block_hash)
+
+    def add(self, block, height, work):
+        self.nodes[block.hash] = (block, height, work)
+        self.children.setdefault(block.prev_hash, set()).add(block.hash)
+
+    def take(self, block_hash):
+        """ Remove a block that joined the chain, the blocks built on it stay """
+        block = self.nodes.pop(block_hash)[0]
+        siblings = self.children.get(block.prev_hash, set())
+        siblings.discard(block_hash)
+        if len(siblings) == 0:
+            self.children.pop(block.prev_hash, None)
+        return block
+
+    def discard(self, block_hash):
+        """ Remove a block that is not valid and every block built on it """
+        pending = [block_hash]
+        while len(pending) > 0:
+            block_hash = pending.pop()
+            pending.extend(self.children.pop(block_hash, ()))
+            if block_hash in self.nodes:
+                self.take(block_hash)
+
+    def branch(self, block_hash):
+        """ Blocks of the tree from the first one whose parent is not in it up to block_hash """
+        blocks = []
+        while block_hash in self.nodes:
+            block = self.nodes[block_hash][0]
+            blocks.append(block)
+            block_hash = block.prev_hash
+        blocks.reverse()
+        return blocks
+
+    def prune(self, height):
+        """ Drop the blocks under height, branches forking that low are too deep to switch to """
+        for block_hash in [block_hash for block_hash, node in self.nodes.items() if node[1] < height]:
+            if block_hash in self.nodes:
+                self.take(block_hash)
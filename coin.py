@@ -4,22 +4,330 @@ The blockchain data structure
 
 """
 
+import binascii
 import datetime
+import functools
 import helper
 import hashlib
 import json
-import nacl.signing
-import nacl.exceptions
+import operator
+import re
+import struct
+import signatures
+import merkle
+import snapshot
+import blockstore
+import blocktree
 from decimal import *
 import network_settings as ns
+from utxo import UnspentSet
+from index import AddressIndex
 
-miner_reward = Decimal("0.1")
+#Amounts are whole numbers of base units, a coin is COIN units
+COIN = 100000000
+UNIT_DIGITS = 8
+
+miner_reward = COIN // 10
 POW_difficulty = ns.POW_DIFFICULTY
 
+#Version of the blocks made here, version 2 blocks hash a Merkle root of their transactions
+BLOCK_VERSION = 2
+
+#Version of the transactions made here, version 2 transactions sign and hash their canonical encoding
+TRANSACTION_VERSION = 2
+
+#Forms of the canonical transaction encoding, transactions between two keys use one fixed layout
+COMPACT_BODY = 0
+GENERIC_BODY = 1
+
+#Field tags of the generic form
+HEX_FIELD = 0
+TEXT_FIELD = 1
+NUMBER_FIELD = 2
+
+SHORT = struct.Struct(">H")
+#sender, receiver, value length, input count
+COMPACT_FIELDS = struct.Struct(">32s32sBH")
+LABELS = struct.Struct(">qq")
+NUMBER = struct.Struct(">q")
+
+#Amounts written as plain digits are read without going through Decimal
+PLAIN_AMOUNT = re.compile(r"([0-9]+)(?:\.([0-9]{1,8}))?\Z")
+
+#Traps any rounding when amounts are scaled to base units
+EXACT = Context(prec=MAX_PREC, traps=[Inexact, InvalidOperation])
+
+#Amounts repeat a lot, rewards and round sums, so text and units are converted through a cache
+AMOUNT_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=AMOUNT_CACHE_SIZE)
+def parse_amount(text):
+    """ Base units of an amount of coin written in decimal, ValueError if it is not a whole number of units """
+    if not isinstance(text, str):
+        raise ValueError("amounts are written as text")
+    plain = PLAIN_AMOUNT.match(text)
+    if plain is not None:
+        whole, fraction = plain.groups()
+        return int(whole) * COIN + int((fraction or "").ljust(UNIT_DIGITS, "0"))
+    try:
+        units = Decimal(text).scaleb(UNIT_DIGITS, context=EXACT)
+    except DecimalException:
+        raise ValueError("invalid amount " + repr(text))
+    if not units.is_finite() or units != units.to_integral_value():
+        raise ValueError("amount " + repr(text) + " is finer than a base unit")
+    return int(units)
+
+@functools.lru_cache(maxsize=AMOUNT_CACHE_SIZE)
+def format_amount(units):
+    """ Shortest decimal text of an amount of base units, the form amounts are hashed, signed and sent in """
+    whole, fraction = divmod(abs(units), COIN)
+    text = str(whole)
+    if fraction != 0:
+        text = text + "." + ("%08d" % fraction).rstrip("0")
+    return "-" + text if units < 0 else text
+
+#Keys are held as hex bytes and sent as text, the genesis block uses plain numbers instead
+def to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("ascii")
+    return value
+
+def from_text(value):
+    if isinstance(value, str):
+        return value.encode("ascii")
+    return value
+
+def encode_field(value, out):
+    """ Append a text, hex bytes or integer field to the bytearray out
+
+    Lowercase hex is stored as the bytes it spells. Fields are decoded back to
+    the type of the field they are read as, the same way from_json loads them.
+    """
+    if type(value) is int:
+        if not -2**63 <= value < 2**63:
+            raise ValueError("integer field " + str(value) + " does not fit in 64 bits")
+        out.append(NUMBER_FIELD)
+        out += NUMBER.pack(value)
+        return
+    text = to_text(value)
+    raw = None
+    if len(text) % 2 == 0:
+        try:
+            raw = bytes.fromhex(text)
+        except ValueError:
+            pass
+    #bytes.fromhex also reads uppercase and spaces, those are kept as text
+    if raw is not None and len(raw) < 256 and raw.hex() == text:
+        out.append(HEX_FIELD)
+        out.append(len(raw))
+        out += raw
+    else:
+        raw = text.encode("utf-8")
+        out.append(TEXT_FIELD)
+        out += SHORT.pack(len(raw))
+        out += raw
+
+def decode_field(data, position):
+    """ Read a field as text or an integer, returns (value, next position) """
+    tag = data[position]
+    if tag == NUMBER_FIELD:
+        return NUMBER.unpack_from(data, position + 1)[0], position + 1 + NUMBER.size
+    if tag == HEX_FIELD:
+        length = data[position + 1]
+        start = position + 2
+        raw = bytes(data[start:start + length])
+        text = raw.hex()
+    elif tag == TEXT_FIELD:
+        length = SHORT.unpack_from(data, position + 1)[0]
+        start = position + 1 + SHORT.size
+        raw = bytes(data[start:start + length])
+        text = raw.decode("utf-8")
+    else:
+        raise ValueError("unknown field tag " + str(tag))
+    if len(raw) != length:
+        raise ValueError("truncated field")
+    return text, start + length
+
+#The 32 bytes a key or hash written as lowercase hex spells, None for anything else
+def hash_bytes(value):
+    text = to_text(value)
+    if not isinstance(text, str) or len(text) != 64:
+        return None
+    try:
+        raw = bytes.fromhex(text)
+    except ValueError:
+        return None
+    return raw if raw.hex() == text else None
+
+#Digests are held as the raw bytes their lowercase hex spells and given back as hex by the attributes of
+#Transaction and Block. Values that are not such hex stay as they are, bytes among them in a tuple.
+def pack_hex(value, size):
+    """ Raw bytes of hex bytes spelling size bytes, for keys and signatures """
+    if type(value) is bytes:
+        if len(value) == 2 * size:
+            try:
+                raw = binascii.unhexlify(value)
+            except binascii.Error:
+                raw = None
+            if raw is not None and binascii.hexlify(raw) == value:
+                return raw
+        return (value,)
+    return value
+
+def hex_bytes(stored):
+    if type(stored) is bytes:
+        return binascii.hexlify(stored)
+    if type(stored) is tuple:
+        return stored[0]
+    return stored
+
+def pack_digest(value):
+    """ Raw bytes of a hash written as hex text """
+    if type(value) is str:
+        if len(value) == 64:
+            try:
+                raw = bytes.fromhex(value)
+            except ValueError:
+                raw = None
+            if raw is not None and raw.hex() == value:
+                return raw
+        return value
+    if type(value) is bytes:
+        return (value,)
+    return value
+
+def digest_text(stored):
+    if type(stored) is bytes:
+        return stored.hex()
+    if type(stored) is tuple:
+        return stored[0]
+    return stored
+
+#Signature of a transaction that has not been signed, as pack_hex holds it
+UNSIGNED = pack_hex(b"0", 64)
+
+#Input hashes are held joined as raw bytes when every one of them is a hash
+def pack_inputs(hashes):
+    if type(hashes) is not list:
+        return hashes
+    raw_inputs = [pack_digest(input_hash) for input_hash in hashes]
+    if all(type(raw) is bytes for raw in raw_inputs):
+        return b"".join(raw_inputs)
+    return hashes
+
+def input_list(stored):
+    if type(stored) is bytes:
+        if len(stored) == 32:
+            return [stored.hex()]
+        text = stored.hex()
+        return [text[start:start + 64] for start in range(0, len(text), 64)]
+    return stored
+
+def encode_body(transaction):
+    """ Canonical encoding of the fields a version 2 transaction's signature covers
+
+        version, form, then for the compact form
+        sender, receiver, value length, input count, value, inputs
+    with keys and input hashes as raw bytes. Transactions that do not fit, like
+    the genesis and reward transactions, list their fields with encode_field.
+    """
+    value = transaction.amount().encode("utf-8")
+    sender = transaction.raw_sender if type(transaction.raw_sender) is bytes else hash_bytes(transaction.raw_sender)
+    receiver = transaction.raw_receiver if type(transaction.raw_receiver) is bytes else hash_bytes(transaction.raw_receiver)
+    if type(transaction.raw_inputs) is bytes:
+        raw_inputs = transaction.raw_inputs
+        count = len(raw_inputs) // 32
+    else:
+        raw_inputs = [hash_bytes(input_hash) if isinstance(input_hash, str) else None for input_hash in transaction.raw_inputs]
+        count = len(raw_inputs)
+        raw_inputs = None if None in raw_inputs else b"".join(raw_inputs)
+    if sender is not None and receiver is not None and raw_inputs is not None and len(value) < 256 and count < 65536:
+        return (bytes([transaction.version, COMPACT_BODY]) + COMPACT_FIELDS.pack(sender, receiver, len(value), count)
+            + value + raw_inputs)
+
+    inputs = transaction.input_transaction_hashes
+    out = bytearray([transaction.version, GENERIC_BODY])
+    out += SHORT.pack(len(inputs))
+    for input_hash in inputs:
+        encode_field(input_hash, out)
+    for field in (transaction.amount(), transaction.sender, transaction.receiver):
+        encode_field(field, out)
+    return bytes(out)
+
+def decode_body(data, position):
+    """ Read an encoding made by encode_body, returns (version, inputs, value, sender, receiver, next position)
+
+    The compact form gives the inputs, sender and receiver as raw bytes, the way Transaction holds them.
+    """
+    version, form = data[position], data[position + 1]
+    position = position + 2
+    if form == COMPACT_BODY:
+        sender, receiver, value_length, count = COMPACT_FIELDS.unpack_from(data, position)
+        position = position + COMPACT_FIELDS.size
+        value = bytes(data[position:position + value_length])
+        position = position + value_length
+        inputs = bytes(data[position:position + 32 * count])
+        if len(value) != value_length or len(inputs) != 32 * count:
+            raise ValueError("truncated transaction")
+        return version, inputs, value.decode("utf-8"), sender, receiver, position + 32 * count
+    if form != GENERIC_BODY:
+        raise ValueError("unknown transaction form " + str(form))
+    count = SHORT.unpack_from(data, position)[0]
+    position = position + SHORT.size
+    fields = []
+    for _ in range(count + 3):
+        field, position = decode_field(data, position)
+        fields.append(field)
+    return (version, fields[:count], fields[count], pack_hex(from_text(fields[count + 1]), 32),
+        pack_hex(from_text(fields[count + 2]), 32), position)
+
 #Ledger class for holding blocks
 class Ledger:
-    def __init__ (self, blocks):
+    def __init__ (self, blocks, state=None):
+        """ blocks is a list or a blockstore.StoredBlocks, state holds indexes saved with index_state """
         self.blocks = blocks
+        if state is None:
+            state = self.build_state(blocks)
+        self.utxo = state["utxo"]
+        self.addresses = state["addresses"]
+        self.heights = state["heights"]
+        #Blocks of competing branches, and the undo journals of the newest blocks of a chain held in memory by hash
+        self.tree = blocktree.BlockTree()
+        self.undo = {}
+
+        #Blocks stored after the state was saved, a crash can have left them without undo records
+        height = state.get("height", len(blocks) - 1) + 1
+        for block in blocks[height:]:
+            journal = self.utxo.apply_block(block)
+            if isinstance(blocks, blockstore.StoredBlocks):
+                blocks.store.append_undo(height, journal)
+            self.index_blocks([block], height)
+            height = height + 1
+
+    #Build the indexes by replaying the blocks
+    @staticmethod
+    def build_state(blocks):
+        utxo = UnspentSet()
+        addresses = AddressIndex()
+        heights = {}
+        for height, block in enumerate(blocks):
+            journal = utxo.apply_block(block)
+            if isinstance(blocks, blockstore.StoredBlocks):
+                blocks.store.append_undo(height, journal)
+            addresses.add_block(block, height)
+            heights[block.hash] = height
+        return {"utxo": utxo, "addresses": addresses, "heights": heights}
+
+    #Indexes to save next to a stored chain so it can be opened without replaying it
+    def index_state(self):
+        return {"utxo": self.utxo, "addresses": self.addresses, "heights": self.heights}
+
+    #Only the blocks are pickled, indexes are rebuilt on load so older ledger files still open
+    def __getstate__(self):
+        return {"blocks": self.blocks}
+
+    def __setstate__(self, state):
+        self.__init__(state["blocks"])
 
     def update (self, block):
 
@@ -39,11 +347,11 @@ class Ledger:
         block.set_block_number(self.current_block_number() + 1)
         block.set_hash()
         print("Created block " + str(block.block_number))
-        self.blocks.append(block)
+        self.append_block(block)
         return True
 
-    #Add new block sent from another node
-    def add (self, block):
+    #Add new block sent from another node, checked means validation.check_block already passed it off the reactor
+    def add (self, block, checked=False):
 
         #Check if we are in the right part of the tree
         if self.current_block_hash() != block.prev_hash:
@@ -62,7 +370,7 @@ class Ledger:
         reward_transaction = block.transactions.pop()
 
         #Check if transactions are valid
-        if helper.valid_block(block, self) == False:
+        if helper.valid_block(block, self, verified=checked) == False:
             print("invalid transactions")
             return False
 
@@ -74,103 +382,201 @@ class Ledger:
         #Add back reward transaction
         block.transactions.append(reward_transaction)
 
-        #Check if hashes was properly computed
-        helper.label_transactions(block, len(self.blocks))
-        provided_hash = block.hash
-        block.set_hash()
-        if block.hash != provided_hash:
-            print("could not duplicate hash")
-            return False
+        #Check if hashes was properly computed, checked blocks were labeled and hashed for this height already
+        if not checked:
+            helper.label_transactions(block, len(self.blocks))
+            provided_hash = block.hash
+            block.set_hash()
+            if block.hash != provided_hash:
+                print("could not duplicate hash")
+                return False
 
-        self.blocks.append(block)
+        self.append_block(block)
         return True
 
-    def add_buffer(self, block_buffer):
-        """ add a buffer of blocks with buffer organized in reverse order """
+    def add_buffer(self, block_buffer, checked=False):
+        """ add a buffer of blocks with buffer organized in reverse order, the parent of the oldest one must be known """
+        while len(block_buffer) > 0:
+            if self.accept(block_buffer.pop(), checked) == False:
+                return False
+        return True
 
-        if block_buffer[0].block_number <= self.current_block_number():
-            return False
-        
-        if block_buffer[-1].prev_hash == self.current_block_hash():
-            while len(block_buffer) > 0:
-                new_block = block_buffer.pop()
-                if self.add(new_block) != True:
-                    return False
-        
-        if self.is_root(block_buffer[-1]):
-            new_block = block_buffer.pop()
+    def knows(self, block_hash):
+        """ True if a block is in the chain or in one of the branches competing with it """
+        return block_hash in self.heights or block_hash in self.tree
 
-            if self.add_root(new_block) == False:
-                return False
+    #Cumulative work of the chain up to height, every block is mined at the same difficulty
+    def chain_work(self, height):
+        return (height + 1) * helper.block_work(POW_difficulty)
 
-            while len(block_buffer) > 0:
-                new_block = block_buffer.pop()
-                if self.add(new_block) == False:
-                    return False
-        
-        return True
+    def accept(self, block, checked=False):
+        """ Add a block that extends the chain or one of the branches competing with it
 
-        
-    def add_root(self, block):
-        """ Add method when we are adding behind the current top block """
-        if self.is_root == False:
+        Returns False if the block is already known, is not valid or its parent is
+        unknown. A branch that gets more work than the chain becomes the chain.
+        """
+        if self.knows(block.hash):
             return False
-
-        if block.block_number == 0:
+        if block.prev_hash == self.current_block_hash():
+            return self.add(block, checked)
+
+        parent = self.tree.get(block.prev_hash)
+        if parent is not None:
+            height = parent[1] + 1
+            work = parent[2] + helper.block_work(POW_difficulty)
+        else:
+            height = self.height_of(block.prev_hash)
+            if height is None or height < self.first_height():
+                return False
+            height = height + 1
+            work = self.chain_work(height)
+        if block.block_number != height or self.check_branch_block(block, checked) == False:
             return False
 
-        #Pop reward transaction from last part of the node
-        reward_transaction = block.transactions.pop()
+        self.tree.add(block, height, work)
+        if work > self.chain_work(self.current_block_number()):
+            return self.reorganize(block.hash)
+        return True
 
-        #Check noonce
-        if helper.check_nonce(self.blocks[block.block_number - 1].hash, block.nonce, POW_difficulty) == False:
+    #Checks of a block of a competing branch that do not need the unspent set, the others are done when it joins the chain
+    def check_branch_block(self, block, checked):
+        if len(block.transactions) == 0 or helper.check_nonce(block.prev_hash, block.nonce, POW_difficulty) == False:
             return False
-
-        #Check if reward is valid
-        if helper.valid_reward(reward_transaction, miner_reward) == False:
-            print("miner reward incorrect")
+        if helper.valid_reward(block.transactions[-1], miner_reward) == False:
             return False
+        if not checked:
+            helper.label_transactions(block, block.block_number)
+            provided_hash = block.hash
+            block.set_hash()
+            if block.hash != provided_hash:
+                return False
+        return True
 
-        #Remove top blocks
-        print("Removing top blocks" + str(block.block_number))
-        extra_blocks = self.blocks[(block.block_number - 1):]
-        self.blocks = self.blocks[0:block.block_number]
-
-        print("new top block" + str(self.blocks[-1].block_number))
+    def reorganize(self, block_hash):
+        """ Make the branch of the tree ending at block_hash the chain, returns False if one of its blocks is not valid
 
-        #Check if transactions are valid
-        if helper.valid_block(block, self) == False:
-            print("invalid transactions")
-            self.blocks.append(extra_blocks)
+        The blocks above the fork are disconnected and kept in the tree. A block of
+        the branch that is not valid is dropped with the blocks built on it, and the
+        chain is put back as it was.
+        """
+        branch = self.tree.branch(block_hash)
+        fork = self.height_of(branch[0].prev_hash)
+        if fork is None or fork < self.first_height():
             return False
+        print("switching to the branch from block " + str(fork + 1) + " to block " + str(branch[-1].block_number))
+        detached = self.disconnect(fork)
+        for block in detached:
+            self.tree.add(block, block.block_number, self.chain_work(block.block_number))
+
+        for block in branch:
+            self.tree.take(block.hash)
+            if self.add(block) == False:
+                print("block " + str(block.block_number) + " of the branch is not valid")
+                self.tree.discard(block.hash)
+                for connected in self.disconnect(fork):
+                    self.tree.add(connected, connected.block_number, self.chain_work(connected.block_number))
+                for old in detached:
+                    self.tree.take(old.hash)
+                    self.append_block(old)
+                return False
+        return True
 
-        #Add back reward transaction
-        block.transactions.append(reward_transaction)
-
-        #Check if hashes was properly computed
-        helper.label_transactions(block, len(self.blocks))
-        provided_hash = block.hash
-        block.set_hash()
-        if block.hash != provided_hash:
-            self.blocks.append(extra_blocks)
-            print("could not duplicate hash")
+    def disconnect(self, height):
+        """ Remove the blocks above height by undoing their journals, returns them oldest first """
+        blocks = self.blocks[height + 1:]
+        journals = [self.journal(block) for block in blocks]
+        del self.blocks[height + 1:]
+        self.unindex_blocks(blocks, height + 1)
+        if None in journals:
+            #Chains held in memory only keep journals for the newest blocks
+            self.utxo = self.replay_utxo()
+        else:
+            for journal in reversed(journals):
+                self.utxo.undo_block(journal)
+        return blocks
+
+    #Check that a block sealed from a template still extends the tip, its transactions were checked as they joined the template
+    def extends_tip(self, block):
+        if block.prev_hash != self.current_block_hash() or block.block_number != len(self.blocks):
             return False
+        return helper.check_nonce(block.prev_hash, block.nonce, POW_difficulty)
 
+    #Append an accepted block and bring the indexes up to date
+    def append_block(self, block):
         self.blocks.append(block)
-        return True
+        height = len(self.blocks) - 1
+        self.heights[block.hash] = height
+        self.addresses.add_block(block, height)
+        journal = self.utxo.apply_block(block)
+        if isinstance(self.blocks, blockstore.StoredBlocks):
+            self.blocks.store.append_undo(height, journal)
+        else:
+            self.undo[block.hash] = journal
+        if height >= blocktree.MAX_DEPTH:
+            self.undo.pop(self.block_hash(height - blocktree.MAX_DEPTH), None)
+        if len(self.tree) > 0:
+            self.tree.prune(height - blocktree.MAX_DEPTH)
+        if isinstance(self.blocks, blockstore.PrunedBlocks):
+            self.blocks.prune(self)
+
+    #Undo journal of a block of the chain, stored chains read it from the block's undo record, None if it was not kept
+    def journal(self, block):
+        if isinstance(self.blocks, blockstore.StoredBlocks):
+            return self.blocks.store.read_undo(block.block_number)
+        return self.undo.pop(block.hash, None)
+
+    #Put blocks back in the hash and address indexes starting at height
+    def index_blocks(self, blocks, height):
+        for block in blocks:
+            self.heights[block.hash] = height
+            self.addresses.add_block(block, height)
+            height = height + 1
+
+    #Remove blocks that used to start at height from the hash and address indexes
+    def unindex_blocks(self, blocks, height):
+        for offset in reversed(range(len(blocks))):
+            del self.heights[blocks[offset].hash]
+            self.addresses.remove_block(blocks[offset], height + offset)
+
+    def block_hash(self, height):
+        """ Return the hash of the block at height, stored chains answer without loading the block
+
+        None for a block under the snapshot a ledger started from that has not been checked yet.
+        """
+        if isinstance(self.blocks, list):
+            return self.blocks[height].hash
+        return self.blocks.block_hash(height)
+
+    def first_height(self):
+        """ Height from which every block up to the tip is held
+
+        That is the snapshot block for a ledger started from a snapshot, and the
+        bottom of the window of a pruned ledger.
+        """
+        if isinstance(self.blocks, (snapshot.SnapshotBlocks, blockstore.PrunedBlocks)):
+            return self.blocks.base
+        return 0
+
+    #Unspent set rebuilt from the start of the chain, or from the one kept at first_height
+    def replay_utxo(self):
+        if isinstance(self.blocks, (snapshot.SnapshotBlocks, blockstore.PrunedBlocks)):
+            return self.blocks.unspent()
+        return UnspentSet.from_blocks(self.blocks)
+
+    def height_of(self, block_hash):
+        """ Return the height of the block with the given hash, None if it is not in the chain """
+        return self.heights.get(block_hash)
+
+    def locate(self, block_hash):
+        """ Height of a block of the chain, unlike height_of it also finds the blocks under the window of a pruned ledger """
+        height = self.heights.get(block_hash)
+        if height is None and isinstance(self.blocks, blockstore.PrunedBlocks):
+            return self.blocks.pruned_height(block_hash)
+        return height
 
     def check_balance(self, address):
         return helper.check_balance(self, address)
 
-    def is_root(self, block):
-        """ Returns true if a block can fit in the ledger """
-        if block.block_number < len(self.blocks):
-            if block.prev_hash == self.blocks[block.block_number - 1].hash and block.hash != self.blocks[block.block_number].hash:
-                print("is root block!")
-                return True
-
-        return False
-
     def current_block_hash(self):
         return self.blocks[-1].hash
 
@@ -180,6 +586,9 @@ class Ledger:
 
 #Block class for holding transactions
 class Block:
+    #processor, prev_hash and hash are held as raw bytes, see pack_hex and pack_digest
+    __slots__ = ("timestamp", "transactions", "raw_processor", "block_number", "raw_prev_hash", "raw_hash", "nonce", "POW_difficulty", "version")
+
     def __init__ (self, transactions, processor, prev_hash, nonce):
         self.timestamp = datetime.datetime.now().timestamp()
         self.transactions = transactions
@@ -189,7 +598,43 @@ class Block:
         self.hash = -1
         self.nonce = nonce
         self.POW_difficulty = POW_difficulty
-        
+        self.version = BLOCK_VERSION
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Block.__slots__}
+
+    #Blocks pickled before versions were added hash their transactions joined, before raw digests they held hex
+    def __setstate__(self, state):
+        self.version = 1
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def processor(self):
+        raw = self.raw_processor
+        return binascii.hexlify(raw) if type(raw) is bytes else hex_bytes(raw)
+
+    @processor.setter
+    def processor(self, value):
+        self.raw_processor = pack_hex(value, 32)
+
+    @property
+    def prev_hash(self):
+        return digest_text(self.raw_prev_hash)
+
+    @prev_hash.setter
+    def prev_hash(self, value):
+        self.raw_prev_hash = pack_digest(value)
+
+    @property
+    def hash(self):
+        raw = self.raw_hash
+        return raw.hex() if type(raw) is bytes else digest_text(raw)
+
+    @hash.setter
+    def hash(self, value):
+        self.raw_hash = pack_digest(value)
+
 
     #Extends transactions for block processing
     def extend_transactions(self, x):
@@ -201,14 +646,57 @@ class Block:
 
     #Set hash of the block
     def set_hash(self):
+        if self.version < 2:
+            transaction_hashes = "".join(str(transaction.hash) for transaction in self.transactions)
+            self.hash = self.hash_with(transaction_hashes.encode('utf-8'))
+        else:
+            self.hash = self.hash_with(self.merkle_root())
+
+    #Hash of the block given what commits to its transactions, the Merkle root or for version 1 their joined hashes
+    def hash_with(self, commitment):
         hash_value = str(self.timestamp) + str(self.processor) + str(self.block_number) + str(self.prev_hash) + str(self.nonce) + str(self.POW_difficulty)
-        for transaction in self.transactions:
-            hash_value = hash_value + str(transaction.hash)
-        self.hash = hashlib.sha256(hash_value.encode('utf-8')).hexdigest()
+        if self.version >= 2:
+            hash_value = hash_value + str(self.version)
+        block_hash = hashlib.sha256(hash_value.encode('utf-8'))
+        block_hash.update(commitment)
+        return block_hash.hexdigest()
+
+    def merkle_root(self):
+        return merkle.merkle_root([transaction.hash for transaction in self.transactions])
+
+    #Header fields and Merkle root, enough to check the block hash without the transactions
+    def header(self):
+        return [self.timestamp, to_text(self.processor), self.prev_hash, self.hash, self.block_number, self.nonce, self.POW_difficulty, self.version, self.merkle_root().hex()]
+
+    def proof(self, position):
+        """ What a light client needs to check the transaction at position is in this block """
+        transaction_hashes = [transaction.hash for transaction in self.transactions]
+        return {"header": self.header(), "transaction": transaction_hashes[position], "proof": merkle.merkle_proof(transaction_hashes, position)}
+
+    @classmethod
+    def check_proof(cls, data):
+        """ Check an answer from proof(), returns the block hash the transaction is proven to be in, None if it is not """
+        try:
+            header = data["header"]
+            block = cls([], from_text(header[1]), header[2], header[5])
+            block.timestamp = header[0]
+            block.block_number = header[4]
+            block.POW_difficulty = header[6]
+            block.version = header[7]
+            root = bytes.fromhex(header[8])
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+        if block.version < 2 or block.hash_with(root) != header[3]:
+            return None
+        if not merkle.verify_proof(data["transaction"], data["proof"], root):
+            return None
+        return header[3]
 
     #Converts block to JSON
     def dump(self):
-        block_data = [self.timestamp, self.processor.decode("ascii"), self.prev_hash, self.hash, self.block_number, self.nonce, self.POW_difficulty]
+        block_data = [self.timestamp, to_text(self.processor), self.prev_hash, self.hash, self.block_number, self.nonce, self.POW_difficulty]
+        if self.version != 1:
+            block_data.append(self.version)
         transaction_data = []
         for transaction in self.transactions:
             transaction_data.append(transaction.dump())
@@ -224,25 +712,33 @@ class Block:
         transactions = []
         for transaction in transaction_data:
             transactions.append(Transaction.from_json(transaction))
-        block = cls(transactions, block_data[1].encode("ascii"), block_data[2], block_data[5])
+        block = cls(transactions, from_text(block_data[1]), block_data[2], block_data[5])
         block.timestamp = block_data[0]
         block.hash = block_data[3]
         block.block_number = block_data[4]
         block.POW_difficulty = block_data[6]
+        block.version = block_data[7] if len(block_data) > 7 else 1
         return block
 
 
 
 #Transaction class representing the sending of coin
 class Transaction:
+    #value is in base units, value_text is (value, text) for a value whose text is not the shortest one
+    #Input hashes, keys, the hash and the signature are held as raw bytes, see pack_hex and pack_digest
+    #body is the encoding of the signed fields made when first needed, body_fields the field objects it was made from
+    __slots__ = ("raw_inputs", "value", "raw_sender", "raw_receiver", "block", "number", "input_value",
+        "raw_hash", "raw_signature", "version", "value_text", "body", "body_fields")
+
     def __init__ (self, input_transaction_hashes, value, sender, receiver):
-        
+        """ value is a whole number of base units, see set_amount for decimal text """
         #Make array is input_transaction_hashes is inputed as string
         if isinstance(input_transaction_hashes, str):
             input_transaction_hashes = [input_transaction_hashes]
             
         self.input_transaction_hashes = input_transaction_hashes
-        self.value = Decimal(value)
+        self.value = value
+        self.value_text = None
         self.sender = sender
         self.receiver = receiver
         self.block = -1
@@ -250,6 +746,114 @@ class Transaction:
         self.input_value = 0
         self.hash = -1
         self.signature = "0".encode("ascii")
+        self.version = TRANSACTION_VERSION
+        self.body = None
+        self.body_fields = None
+
+    @classmethod
+    def from_raw(cls, raw_inputs, value, raw_sender, raw_receiver):
+        """ Make a transaction from fields held the way its slots hold them, without checking them again """
+        obj = cls.__new__(cls)
+        obj.raw_inputs = raw_inputs
+        obj.value = value
+        obj.value_text = None
+        obj.raw_sender = raw_sender
+        obj.raw_receiver = raw_receiver
+        obj.block = -1
+        obj.number = -1
+        obj.input_value = 0
+        obj.raw_hash = -1
+        obj.raw_signature = UNSIGNED
+        obj.version = TRANSACTION_VERSION
+        obj.body = None
+        obj.body_fields = None
+        return obj
+
+    #The cached encoding is left out, it is made again when needed
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in Transaction.__slots__[:-2]}
+
+    #Transactions pickled before versions were added are version 1, before base units their value was a Decimal
+    #and before raw digests they held hex
+    def __setstate__(self, state):
+        self.version = 1
+        self.value_text = None
+        self.body = None
+        self.body_fields = None
+        for name, value in state.items():
+            setattr(self, name, value)
+        if isinstance(self.value, Decimal):
+            self.migrate_amount(self.value)
+
+    #Before base units an amount could be finer than a unit, it is rounded down and keeps the text it was signed with
+    def migrate_amount(self, amount):
+        text = str(amount)
+        if not amount.is_finite():
+            raise ValueError("transaction " + str(self.hash) + " was pickled with amount " + text + " that is not a number")
+        units = amount.scaleb(UNIT_DIGITS, context=EXACT)
+        self.value = int(units.to_integral_value(rounding=ROUND_DOWN))
+        self.value_text = None if format_amount(self.value) == text else (self.value, text)
+
+    def __copy__(self):
+        transaction = Transaction.__new__(Transaction)
+        transaction.raw_inputs = self.raw_inputs
+        transaction.value = self.value
+        transaction.raw_sender = self.raw_sender
+        transaction.raw_receiver = self.raw_receiver
+        transaction.block = self.block
+        transaction.number = self.number
+        transaction.input_value = self.input_value
+        transaction.raw_hash = self.raw_hash
+        transaction.raw_signature = self.raw_signature
+        transaction.version = self.version
+        transaction.value_text = self.value_text
+        transaction.body = self.body
+        transaction.body_fields = self.body_fields
+        return transaction
+
+    @property
+    def input_transaction_hashes(self):
+        return input_list(self.raw_inputs)
+
+    @input_transaction_hashes.setter
+    def input_transaction_hashes(self, value):
+        self.raw_inputs = pack_inputs(value)
+
+    @property
+    def sender(self):
+        raw = self.raw_sender
+        return binascii.hexlify(raw) if type(raw) is bytes else hex_bytes(raw)
+
+    @sender.setter
+    def sender(self, value):
+        self.raw_sender = pack_hex(value, 32)
+
+    @property
+    def receiver(self):
+        raw = self.raw_receiver
+        return binascii.hexlify(raw) if type(raw) is bytes else hex_bytes(raw)
+
+    @receiver.setter
+    def receiver(self, value):
+        self.raw_receiver = pack_hex(value, 32)
+
+    @property
+    def hash(self):
+        raw = self.raw_hash
+        return raw.hex() if type(raw) is bytes else digest_text(raw)
+
+    @hash.setter
+    def hash(self, value):
+        self.raw_hash = pack_digest(value)
+
+    @property
+    def signature(self):
+        raw = self.raw_signature
+        return binascii.hexlify(raw) if type(raw) is bytes else hex_bytes(raw)
+
+    @signature.setter
+    def signature(self, value):
+        self.raw_signature = pack_hex(value, 64)
     
     #Set which block the transaction has been recorded in
     def set_block (self, x):
@@ -265,44 +869,103 @@ class Transaction:
 
     #verify transaction
     def verify (self):
-        try:
-            verify_key = nacl.signing.VerifyKey(self.sender, encoder=nacl.encoding.HexEncoder)
-            message = nacl.encoding.HexEncoder.encode(self.verify_dump().encode("ascii"))
-            verify_key.verify(message, self.signature, encoder=nacl.encoding.HexEncoder)
-        except nacl.exceptions.BadSignatureError:
+        if signatures.verify_transaction(self) == False:
             print("invalid transaction")
             return False
         return True
 
+    def set_amount (self, text):
+        """ Set the value from decimal text, text that is not in its shortest form is kept to hash and send as it was """
+        self.value = parse_amount(text)
+        self.value_text = None if format_amount(self.value) == text else (self.value, text)
+
+    #Value as decimal text, the form it is hashed, signed and sent in
+    def amount (self):
+        if self.value_text is not None and self.value_text[0] == self.value:
+            return self.value_text[1]
+        return format_amount(self.value)
+
     #Set the input_value of the function, can this functionality be removed?
     def set_input_value (self, x):
         self.input_value = x
 
     #Set the hash for the transaction
     def set_hash (self):
-        hash_value = str(self.input_transaction_hashes) + str(self.value) + str(self.sender) + str(self.receiver) + str(self.block) + str(self.number) + str(self.signature)
-        self.hash = hashlib.sha256(hash_value.encode('utf-8')).hexdigest()
+        if self.version < 2:
+            hash_value = str(self.input_transaction_hashes) + self.amount() + str(self.sender) + str(self.receiver) + str(self.block) + str(self.number) + str(self.signature)
+            self.hash = hashlib.sha256(hash_value.encode('utf-8')).hexdigest()
+            return
+        hash_value = self.signed_bytes() + LABELS.pack(self.block, self.number) + from_text(self.signature)
+        self.raw_hash = hashlib.sha256(hash_value).digest()
+
+    def signed_bytes (self):
+        """ The message the sender signs, the canonical encoding of the signed fields from version 2 on
+
+        It is made again when one of the fields has been set to another object
+        since.
+        """
+        fields = self.signed_fields()
+        if self.body is None or not all(map(operator.is_, fields, self.body_fields)):
+            if self.version < 2:
+                self.body = self.verify_dump().encode("ascii")
+            else:
+                self.body = encode_body(self)
+            self.body_fields = fields
+        return self.body
+
+    def signed_fields (self):
+        return (self.raw_inputs, self.value, self.value_text, self.raw_sender, self.raw_receiver, self.version)
+
+    @classmethod
+    def from_body(cls, data, position):
+        """ Load the signed fields of a version 2 transaction, returns (transaction, next position)
+
+        The bytes read are kept as the transaction's encoding, so anything that
+        does not encode back to the same bytes is turned down.
+        """
+        start = position
+        version, inputs, value, sender, receiver, position = decode_body(data, position)
+        if version < 2:
+            raise ValueError("not a canonical transaction")
+        obj = cls.from_raw(inputs if type(inputs) is bytes else pack_inputs(inputs), 0, sender, receiver)
+        obj.version = version
+        obj.set_amount(value)
+        body = bytes(data[start:position])
+        if data[start + 1] == COMPACT_BODY:
+            obj.body = body
+            obj.body_fields = obj.signed_fields()
+        elif obj.signed_bytes() != body:
+            raise ValueError("transaction is not canonically encoded")
+        return obj, position
+
+    #Hash of what the sender signed, identifies a transaction before a block sets its hash
+    def signed_hash (self):
+        return hashlib.sha256(self.signed_bytes() + from_text(self.signature)).hexdigest()
 
     #Converts transaction to JSON
     def dump(self):
-        data = [self.input_transaction_hashes, str(self.value), self.sender.decode("ascii"), self.receiver.decode("ascii"), self.block, self.number, self.input_value, self.hash, self.signature.decode("ascii")]
+        data = [self.input_transaction_hashes, self.amount(), to_text(self.sender), to_text(self.receiver), self.block, self.number, self.input_value, self.hash, to_text(self.signature)]
+        if self.version != 1:
+            data.append(self.version)
         return json.dumps(data)
 
-    #Dump without signature and block information for verification
+    #Dump without signature and block information for verification, the message version 1 transactions sign
     def verify_dump(self):
-        data = [self.input_transaction_hashes, str(self.value), self.sender.decode("ascii"), self.receiver.decode("ascii")]
+        data = [self.input_transaction_hashes, self.amount(), self.sender.decode("ascii"), self.receiver.decode("ascii")]
         return json.dumps(data)
 
     #Load object from JSON
     @classmethod
     def from_json(cls, data):
         data = json.loads(data)
-        obj = cls(data[0], data[1], data[2].encode("ascii"), data[3].encode("ascii"))
+        obj = cls(data[0], 0, from_text(data[2]), from_text(data[3]))
+        obj.set_amount(data[1])
         obj.block = data[4]
         obj.number = data[5]
         obj.input_value = data[6]
         obj.hash = data[7]
-        obj.signature = data[8].encode("ascii")
+        obj.signature = from_text(data[8])
+        obj.version = data[9] if len(data) > 9 else 1
         return obj
 
 
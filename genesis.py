@@ -4,7 +4,7 @@ Program to create the genesis block
 
 """
 
-from coin import Block, Transaction, Ledger
+from coin import Block, Transaction, Ledger, COIN
 import pickle
 import helper
 import nacl.encoding
@@ -21,7 +21,7 @@ pubkey = verify_key.encode(encoder=nacl.encoding.HexEncoder)
 
 #Generate the first block of the chain
 def genesis():
-    value = 1
+    value = COIN
     genesis_transaction = Transaction("0", value, -1, pubkey)
     genesis_transactions = [genesis_transaction]
     genesis_block = Block(genesis_transactions, 0, 0, 0)
@@ -0,0 +1,149 @@
+"""
+
+Announce and request relay of blocks and transactions
+
+Peers with the "inv" feature are sent the hashes of new blocks and transactions
+(inv) and ask for the bodies they have not seen (getData), so each body crosses
+to a node once however many peers announce it. Older peers still get full bodies.
+Hashes seen recently are kept in a bounded set that forgets entries after a while.
+
+"""
+
+from collections import OrderedDict, deque
+
+#Hashes remembered as seen, and for how many seconds
+SEEN_SIZE = 50000
+SEEN_EXPIRY = 600
+
+#Bodies kept to answer getData for what we announced
+ANNOUNCED_SIZE = 5000
+
+#Commands that carry the full body of each kind of item
+BODY_COMMANDS = {"block": "newBlock", "tx": "transaction"}
+
+#Set of recently seen keys, bounded in size and age
+class SeenSet:
+    def __init__ (self, size, expiry):
+        self.size = size
+        self.expiry = expiry
+        self.times = OrderedDict()
+
+    def expire(self, now):
+        while len(self.times) > 0:
+            key, seen_time = next(iter(self.times.items()))
+            if len(self.times) <= self.size and now - seen_time < self.expiry:
+                break
+            del self.times[key]
+
+    def add(self, key, now):
+        """ Mark key as seen, returns False if it already was """
+        self.expire(now)
+        if key in self.times:
+            return False
+        self.times[key] = now
+        return True
+
+    def discard(self, key):
+        self.times.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.times
+
+    def __len__(self):
+        return len(self.times)
+
+
+#Key used in inv and getData messages for a block or transaction
+def item_key(kind, item):
+    if kind == "block":
+        return (kind, item.hash)
+    return (kind, item.signed_hash())
+
+class Gossip:
+    def __init__ (self, factory):
+        self.factory = factory
+        self.seen = SeenSet(SEEN_SIZE, SEEN_EXPIRY)
+        self.announced = OrderedDict()
+        #key -> [peer asked, other peers that announced it]
+        self.requested = {}
+
+    def now(self):
+        return self.factory.reactor.seconds()
+
+    def received(self, kind, item):
+        """ Note that a body arrived, returns False if it was seen before """
+        key = item_key(kind, item)
+        self.requested.pop(key, None)
+        return self.seen.add(key, self.now())
+
+    def rejected(self, kind, item):
+        """ Forget a body that was not accepted, it can be asked for again once we may accept it, as after catching up """
+        self.seen.discard(item_key(kind, item))
+
+    def relay(self, kind, item, source=None):
+        """ Pass an accepted block or transaction on to every peer except source """
+        key = item_key(kind, item)
+        self.seen.add(key, self.now())
+        self.announced[key] = item
+        if len(self.announced) > ANNOUNCED_SIZE:
+            self.announced.popitem(last=False)
+
+        encoded = {}
+        for peer in self.factory.peers.values():
+            if peer is source:
+                continue
+            if "inv" in peer.features:
+                peer.sendData("inv", [list(key)])
+            else:
+                #Bodies for older peers are encoded once per format
+                if peer.binary not in encoded:
+                    encoded[peer.binary] = peer.encode(BODY_COMMANDS[kind], item)
+                peer.sendEncoded(encoded[peer.binary])
+
+    def known(self, key):
+        if key in self.seen or key in self.announced:
+            return True
+        if key[0] == "tx":
+            return key[1] in self.factory.mempool
+        return self.factory.ledger.height_of(key[1]) is not None
+
+    def receiveInv(self, peer, items):
+        """ Ask the announcing peer for the bodies we have not seen """
+        wanted = []
+        for kind, item_hash in items:
+            key = (kind, item_hash)
+            if kind not in BODY_COMMANDS:
+                continue
+            if key in self.requested:
+                self.requested[key][1].append(peer)
+            elif not self.known(key):
+                self.requested[key] = [peer, deque()]
+                wanted.append([kind, item_hash])
+        if len(wanted) > 0:
+            peer.sendData("getData", wanted)
+            self.factory.reactor.callLater(self.factory.ns.REQUEST_TIMEOUT, self.requestTimeout, peer, wanted)
+
+    def requestTimeout(self, peer, items):
+        """ Ask the next announcer for bodies the first one did not deliver """
+        for kind, item_hash in items:
+            key = (kind, item_hash)
+            entry = self.requested.get(key)
+            if entry is None or entry[0] is not peer:
+                continue
+            if len(entry[1]) == 0:
+                del self.requested[key]
+                continue
+            entry[0] = entry[1].popleft()
+            entry[0].sendData("getData", [[kind, item_hash]])
+            self.factory.reactor.callLater(self.factory.ns.REQUEST_TIMEOUT, self.requestTimeout, entry[0], [[kind, item_hash]])
+
+    def receiveGetData(self, peer, items):
+        """ Send the bodies a peer asked for """
+        for kind, item_hash in items:
+            key = (kind, item_hash)
+            if key in self.announced:
+                peer.sendData(BODY_COMMANDS[kind], self.announced[key])
+            elif kind == "block":
+                height = self.factory.ledger.height_of(item_hash)
+                if height is not None:
+                    peer.sendBlock(height, "newBlock")
@@ -6,19 +6,15 @@ Helper functions for the coin.py blockchain data structure file
 
 import hashlib
 import coin
-import copy
 import nacl
-from decimal import *
+import POW
+import signatures
 
-#Function to get all transactions associated with an address
+#Function to get all transactions associated with an address, located through the ledger's address index
 def get_transactions_user (ledger, address):
     transactions = []
-    #Go through blockchain and find all transactions for address
-    for block in ledger.blocks:
-        for transaction in block.transactions:
-            if transaction.receiver == address or transaction.sender == address:
-                transactions.append(transaction)
-                #print("Sender:" + transaction.sender + "; Receiver:" + transaction.receiver + "; Value:" + str(transaction.output))
+    for height, position in ledger.addresses.transaction_locations(address):
+        transactions.append(ledger.blocks[height].transactions[position])
     return transactions
 
 def get_transactions (ledger):
@@ -31,20 +27,7 @@ def get_transactions (ledger):
 
 #Check balance of coins for address, assumes all transactions in ledger are valid
 def check_balance(ledger, address):
-
-    #List of all transactions
-    transactions = get_transactions_user(ledger, address)
-
-    #Balance of wallet
-    balance = 0
-
-    #Sums up value of transactions, needs update for more complete transaction handeling
-    for entry in transactions:
-        if entry.receiver == address:
-            balance += entry.value
-        if entry.sender == address:
-            balance -= entry.value
-    return balance 
+    return ledger.addresses.balance(address)
 
 
 #Label and assign hash value to transactions once assigned to block
@@ -55,35 +38,14 @@ def label_transactions(block, block_num):
         transaction.set_number(counter)
         transaction.set_hash()
 
-#Get list of unspent transactions for a user
+#Get list of unspent transactions for a user, copies so callers can modify them
 def get_unspent_transactions_user(ledger, address):
-    transactions = get_transactions_user(ledger, address)
-    spent_transactions = []
-    for transaction in transactions:
-        spent_transactions.extend(transaction.input_transaction_hashes)
-    
-    unspent_transactions = []
-    for transaction in transactions:
-        if (transaction.hash not in spent_transactions) & (transaction.receiver == address):
-            unspent_transactions.append(transaction)
-        
-    return copy.deepcopy(unspent_transactions)
+    unspent_transactions = ledger.utxo.view()
+    return [unspent_transactions.get(transaction_hash) for transaction_hash in ledger.utxo.address_hashes(address)]
 
-#Get unspent transactions for the ledger
+#Get unspent transactions for the ledger, copies taken from the ledger's unspent set
 def get_unspent_transactions(ledger):
-    blocks = ledger.blocks
-    spent_transactions = []
-    for block in blocks:
-        for transaction in block.transactions:
-            spent_transactions.extend(transaction.input_transaction_hashes)
-    
-    unspent_transactions = []
-    for block in blocks:
-        for transaction in block.transactions:
-            if (transaction.hash not in spent_transactions):
-                unspent_transactions.append(transaction)
-
-    return copy.deepcopy(unspent_transactions)
+    return ledger.utxo.view().all()
 
 #Check transaction for validity
 def valid_transaction (transaction, ledger, unspent_transactions):
@@ -97,24 +59,28 @@ def valid_transaction (transaction, ledger, unspent_transactions):
 
 #Function for preparing block for publication
 def process_block (block, ledger):
-    unspent_transactions = get_unspent_transactions(ledger)
+    unspent_transactions = ledger.utxo.view()
     valid_transactions = []
     input_transactions = []
 
+    #Check every signature of the block in one batch
+    verified = signatures.verify_transactions(block.transactions)
+
     #Iterate through and verify correct balance for input transactions
-    for transaction in block.transactions:
+    for transaction, signed in zip(block.transactions, verified):
         
         #Verify user signed transaction
-        if transaction.verify():
+        if signed:
             
             #Check value of input transactions is sufficient for value of the transaction 
             total = 0
             inputs = []
-            for unspent_transaction in unspent_transactions:
-                if unspent_transaction.hash in transaction.input_transaction_hashes:
+            for input_hash in dict.fromkeys(transaction.input_transaction_hashes):
+                unspent_transaction = unspent_transactions.get(input_hash)
+                if unspent_transaction is not None:
                     
-                    #Make sure the sender owns the transaction
-                    if unspent_transaction.receiver == transaction.sender:
+                    #Make sure the sender owns the transaction, raw keys are equal when their hex is
+                    if unspent_transaction.raw_receiver == transaction.raw_sender:
                         total = total + unspent_transaction.value
                         inputs.append(unspent_transaction)
 
@@ -140,25 +106,26 @@ def process_block (block, ledger):
 
     return valid_transactions
         
-#Check block is valid
-def valid_block (block, ledger):
-    unspent_transactions = get_unspent_transactions(ledger)
+#Check block is valid, verified skips the signatures when they were checked already
+def valid_block (block, ledger, verified=False):
+    unspent_transactions = ledger.utxo.view()
     used_input_transactions = []
+
+    #Check signatures of the non-change transactions in one batch
+    if not verified and False in signatures.verify_transactions(signed_transactions(block.transactions)):
+        print("transaction not verified")
+        return False
+
     for transaction in block.transactions:
-        
-        #Check if non-change transactions have valid signature
-        if transaction.sender != transaction.receiver:
-            if transaction.verify() == False:
-                print("transaction not verified")
-                return False
 
         #Check value of input transactions is sufficient for value of the transaction 
         total = 0
         inputs = []
-        for unspent_transaction in unspent_transactions:
-            if unspent_transaction.hash in transaction.input_transaction_hashes:
-                #Make sure the sender owns the transaction
-                if unspent_transaction.receiver == transaction.sender:
+        for input_hash in dict.fromkeys(transaction.input_transaction_hashes):
+            unspent_transaction = unspent_transactions.get(input_hash)
+            if unspent_transaction is not None:
+                #Make sure the sender owns the transaction, raw keys are equal when their hex is
+                if unspent_transaction.raw_receiver == transaction.raw_sender:
                     total = total + unspent_transaction.value
                     inputs.append(unspent_transaction)
 
@@ -187,6 +154,10 @@ def valid_block (block, ledger):
                     
 
 
+#Transactions that carry a user's signature, change transactions are made by the block
+def signed_transactions(transactions):
+    return [transaction for transaction in transactions if transaction.raw_sender != transaction.raw_receiver]
+
 #Return change on block
 def return_change(block):
     change_transactions = []
@@ -209,19 +180,10 @@ def valid_reward(transaction, miner_reward):
    z = transaction.input_transaction_hashes == ["0"]
    return x and y and z
 
-def check_nonce(hash_value, nonce, POW_difficulty):
-    target = ""
-    for _ in range(POW_difficulty):
-        target = target + "0"
-    
-    result = hashlib.sha256((hash_value+str(nonce)).encode('utf-8')).hexdigest()
-
-    if result[:POW_difficulty] == target:
-        return True
-    
-    return False
-
-
-        
-        
+#Work a block mined at a difficulty adds to its chain, the number of hashes expected to find its nonce
+def block_work(POW_difficulty):
+    return 2 ** 256 // max(int.from_bytes(POW.difficulty_target(POW_difficulty), "big"), 1)
 
+def check_nonce(hash_value, nonce, POW_difficulty):
+    result = hashlib.sha256((hash_value+str(nonce)).encode('utf-8')).digest()
+    return result < POW.difficulty_target(POW_difficulty)
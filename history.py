@@ -0,0 +1,143 @@
+"""
+
+Background check of the blocks under a UTXO snapshot
+
+A ledger started from a snapshot (see snapshot.py) holds no blocks under the
+snapshot block. HistorySync asks peers for them from genesis up (getHistory /
+historyBlock), one small batch at a time and only while the tip is not being
+synced, and adds them to a second ledger kept in the node's block store. The
+blocks come through the validation pipeline, so only the ledger checks are left.
+
+When that ledger reaches the snapshot block its unspent set and balances must
+give the digest the snapshot committed to. It then takes the blocks added above
+the snapshot and the node's ledger switches over to it. A snapshot that does not
+match the chain is reported, and the chain is kept up to the first block that
+is not valid on the state the history really gives.
+
+"""
+
+import os
+import snapshot
+
+#Blocks asked for in one getHistory request
+BATCH_SIZE = 16
+
+#Seconds between checks for a batch to ask for
+INTERVAL = 1
+
+class HistorySync:
+    def __init__(self, factory):
+        self.factory = factory
+        #Peer the current batch was asked from, the heights it covers and when it was asked
+        self.peer = None
+        self.batch = None
+        self.sent_at = None
+        #height -> block of the batch received ahead of the next one to add
+        self.received = {}
+        #Peers that did not deliver a batch, asked again only when no other peer is left
+        self.failed = set()
+
+    def active(self):
+        return isinstance(self.factory.ledger.blocks, snapshot.SnapshotBlocks)
+
+    def start(self):
+        """ Check the history of a ledger started from a snapshot in the background, other ledgers have nothing to check """
+        if self.active():
+            self.factory.reactor.callLater(INTERVAL, self.tick)
+
+    def tick(self):
+        if not self.active():
+            return
+        if self.peer is not None and self.factory.reactor.seconds() - self.sent_at > self.factory.ns.REQUEST_TIMEOUT:
+            self.peer.recordLatency(self.factory.ns.REQUEST_TIMEOUT)
+            self.failed.add(self.peer)
+            self.clear()
+        if self.peer is None:
+            self.next()
+        self.factory.reactor.callLater(INTERVAL, self.tick)
+
+    def clear(self):
+        self.peer = None
+        self.batch = None
+        self.sent_at = None
+        self.received = {}
+
+    def next(self):
+        """ Ask for the next batch, or switch over once every block under the snapshot is checked """
+        chain = self.factory.ledger.blocks
+        start = len(chain.history.blocks)
+        if start >= chain.base:
+            self.finish()
+            return
+        #Syncing the tip comes first
+        if self.factory.sync.active():
+            return
+        peer = self.choosePeer()
+        if peer is None:
+            return
+        self.peer = peer
+        self.batch = (start, min(start + BATCH_SIZE, chain.base))
+        self.sent_at = self.factory.reactor.seconds()
+        peer.sendData("getHistory", [start, self.batch[1] - start])
+
+    def choosePeer(self):
+        peers = [peer for peer in self.factory.peers.values() if peer.state == "CONNECTED" and "history" in peer.features]
+        fresh = [peer for peer in peers if peer not in self.failed]
+        if len(fresh) == 0:
+            self.failed = set()
+            fresh = peers
+        if len(fresh) == 0:
+            return None
+        return min(fresh, key=lambda peer: peer.latency)
+
+    def receiveBlock(self, peer, block):
+        if peer is not self.peer or not self.batch[0] <= block.block_number < self.batch[1]:
+            return
+        self.received[block.block_number] = block
+
+        #Add the blocks that are next in chain order
+        history = self.factory.ledger.blocks.history
+        while len(history.blocks) in self.received:
+            block = self.received.pop(len(history.blocks))
+            if history.add(block, checked=True) == False:
+                print("history block " + str(block.block_number) + " rejected")
+                self.failed.add(peer)
+                self.clear()
+                return
+
+        if len(history.blocks) >= self.batch[1]:
+            peer.recordLatency(self.factory.reactor.seconds() - self.sent_at)
+            self.clear()
+            self.next()
+
+    def finish(self):
+        """ Add the snapshot block and the blocks above it to the checked history and switch the ledger over to it """
+        ledger = self.factory.ledger
+        chain = ledger.blocks
+        history = chain.history
+        matched = len(history.blocks) == chain.base + 1 and matches(history, chain.snapshot)
+        for height in range(len(history.blocks), len(chain)):
+            if history.add(chain[height]) == False:
+                print("block " + str(height) + " is not valid on the checked history, the chain is cut there")
+                break
+            if height == chain.base:
+                matched = matches(history, chain.snapshot)
+        if matched:
+            print("history checked back to genesis, the snapshot matches the chain")
+        else:
+            print("the snapshot does not match the chain, switching to the state its history gives")
+
+        ledger.blocks = history.blocks
+        ledger.utxo = history.utxo
+        ledger.addresses = history.addresses
+        ledger.heights = history.heights
+        ledger.undo = history.undo
+        store = history.blocks.store
+        store.save_state(ledger)
+        os.remove(os.path.join(store.directory, snapshot.PENDING_FILE))
+        self.clear()
+        self.factory.resetPOW()
+
+#True if a ledger at the snapshot block has the state the snapshot committed to
+def matches(ledger, snapshot_state):
+    return snapshot.state_digest(ledger.utxo, ledger.addresses.balances) == snapshot_state.digest
@@ -0,0 +1,79 @@
+"""
+
+Per address index of the ledger, kept in step with the blocks as they are added and removed
+
+"""
+
+import bisect
+from utxo import Overlay
+
+#Transaction locations and balance for each address
+class AddressIndex:
+    def __init__ (self):
+        #address -> list of (block height, position in block) of its transactions
+        self.locations = {}
+        self.balances = {}
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        index = cls()
+        for height, block in enumerate(blocks):
+            index.add_block(block, height)
+        return index
+
+    def add_block(self, block, height):
+        for position, transaction in enumerate(block.transactions):
+            for address in self.addresses(transaction):
+                self.locations.setdefault(address, []).append((height, position))
+            self.balances[transaction.receiver] = self.balances.get(transaction.receiver, 0) + transaction.value
+            self.balances[transaction.sender] = self.balances.get(transaction.sender, 0) - transaction.value
+
+    def remove_block(self, block, height):
+        """ Undo add_block, blocks must be removed from the top of the chain down """
+        for transaction in block.transactions:
+            for address in self.addresses(transaction):
+                locations = self.locations.get(address, [])
+                while len(locations) > 0 and locations[-1][0] == height:
+                    locations.pop()
+                if len(locations) == 0:
+                    self.locations.pop(address, None)
+            self.balances[transaction.receiver] = self.balances.get(transaction.receiver, 0) - transaction.value
+            self.balances[transaction.sender] = self.balances.get(transaction.sender, 0) + transaction.value
+
+    def freeze(self):
+        """ Index as it is now, to be pickled on another thread
+
+        The locations are copied, the balances are held unchanged until thaw() with
+        the changes made meanwhile on top of them, see utxo.Overlay.
+        """
+        index = AddressIndex()
+        index.locations = {address: list(locations) for address, locations in self.locations.items()}
+        index.balances = self.balances
+        self.balances = Overlay(self.balances)
+        return index
+
+    def thaw(self):
+        if isinstance(self.balances, Overlay):
+            self.balances = self.balances.merged()
+
+    def prune(self, height):
+        """ Forget the locations under height, a pruned ledger no longer holds those blocks """
+        for address in list(self.locations):
+            locations = self.locations[address]
+            start = bisect.bisect_left(locations, (height,))
+            if start == len(locations):
+                del self.locations[address]
+            elif start > 0:
+                self.locations[address] = locations[start:]
+
+    #Addresses a transaction belongs to, change transactions only count once
+    def addresses(self, transaction):
+        if transaction.sender == transaction.receiver:
+            return [transaction.receiver]
+        return [transaction.sender, transaction.receiver]
+
+    def balance(self, address):
+        return self.balances.get(address, 0)
+
+    def transaction_locations(self, address):
+        return self.locations.get(address, [])
@@ -0,0 +1,158 @@
+"""
+
+Pool of pending transactions waiting for a block
+
+Transactions are kept by signed hash in the order they arrived. Each one spends
+unspent outputs of the ledger that no other pooled transaction spends, so the
+whole pool can go into the next block without being checked again, and a block
+template is kept up to date as transactions are admitted. After the
+tip moves the pool is checked against the new unspent set, and transactions of
+blocks that left the chain in a reorg are offered to it again.
+
+"""
+
+import copy
+import signatures
+from template import BlockTemplate
+from collections import OrderedDict, deque
+
+#Transactions kept, the oldest are evicted past this
+MAX_TRANSACTIONS = 5000
+
+#Blocks remembered so their transactions can be re-admitted if a reorg removes them
+RECENT_BLOCKS = 100
+
+class Mempool:
+    def __init__ (self, ledger, processor, size=MAX_TRANSACTIONS):
+        """ processor is the address the reward of blocks built from the template goes to """
+        self.ledger = ledger
+        self.size = size
+        self.template = BlockTemplate(ledger, processor)
+        #signed hash -> transaction, oldest first
+        self.entries = OrderedDict()
+        #unspent transaction hash -> signed hash of the pooled transaction spending it
+        self.spenders = {}
+        self.tip = ledger.current_block_hash()
+        #(block hash, transactions) of the blocks the pool has seen join the chain
+        self.recent = deque(maxlen=RECENT_BLOCKS)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, signed_hash):
+        return signed_hash in self.entries
+
+    def get(self, signed_hash):
+        return self.entries.get(signed_hash)
+
+    def spender(self, transaction_hash):
+        """ Signed hash of the pooled transaction spending an unspent output, None if it is free """
+        return self.spenders.get(transaction_hash)
+
+    def inputs(self, transaction):
+        """ Hashes of the unspent outputs a transaction spends, None if it could not go in the next block """
+        if transaction.value <= 0 or len(transaction.input_transaction_hashes) == 0:
+            return None
+        total = 0
+        inputs = list(dict.fromkeys(transaction.input_transaction_hashes))
+        for input_hash in inputs:
+            entry = self.ledger.utxo.outputs.get(input_hash)
+            if entry is None or entry[0].receiver != transaction.sender:
+                return None
+            total = total + entry[1]
+        if total < transaction.value:
+            return None
+        return inputs
+
+    def add(self, transaction, verified=False):
+        """ Add a transaction, returns False if it is known, invalid or spends what a pooled transaction spends """
+        signed_hash = transaction.signed_hash()
+        if signed_hash in self.entries:
+            return False
+        inputs = self.inputs(transaction)
+        if inputs is None:
+            return False
+        if any(input_hash in self.spenders for input_hash in inputs):
+            return False
+        if not verified and signatures.verify_transaction(transaction) == False:
+            return False
+
+        self.entries[signed_hash] = transaction
+        for input_hash in inputs:
+            self.spenders[input_hash] = signed_hash
+        self.template.add(transaction)
+        while len(self.entries) > self.size:
+            self.remove(next(iter(self.entries)))
+        return True
+
+    def remove(self, signed_hash):
+        transaction = self.entries.pop(signed_hash)
+        self.template.stale = True
+        for input_hash in dict.fromkeys(transaction.input_transaction_hashes):
+            if self.spenders.get(input_hash) == signed_hash:
+                del self.spenders[input_hash]
+
+    def transactions(self):
+        """ Transactions for the next block, in the order they arrived """
+        return list(self.entries.values())
+
+    def block_template(self):
+        """ Template of the next block, only rebuilt when evictions or a missed tip change left it behind """
+        self.refresh()
+        if self.template.stale or self.template.prev_hash != self.ledger.current_block_hash():
+            self.template.reset(self.transactions())
+        return self.template
+
+    def refresh(self):
+        """ Bring the pool up to date after the tip of the ledger moved
+
+        Transactions the new blocks include, or whose inputs they spent, are dropped.
+        Transactions of blocks removed by a reorg are offered again ahead of the rest.
+        """
+        ledger = self.ledger
+        if ledger.current_block_hash() == self.tip:
+            return
+
+        #Blocks the pool saw that are no longer in the chain
+        detached = []
+        while len(self.recent) > 0 and ledger.height_of(self.recent[-1][0]) is None:
+            detached.append(self.recent.pop()[1])
+
+        #Blocks that joined since the last refresh
+        if len(self.recent) > 0:
+            height = ledger.height_of(self.recent[-1][0]) + 1
+        elif ledger.height_of(self.tip) is not None:
+            height = ledger.height_of(self.tip) + 1
+        else:
+            height = max(len(ledger.blocks) - RECENT_BLOCKS, ledger.first_height())
+        mined = set()
+        for block_height in range(height, len(ledger.blocks)):
+            block = ledger.blocks[block_height]
+            self.recent.append((block.hash, block.transactions))
+            mined.update(transaction.signed_hash() for transaction in block.transactions)
+
+        candidates = []
+        for transactions in reversed(detached):
+            for transaction in transactions:
+                #Reward and change transactions are made by the block, not sent by users
+                if transaction.sender == transaction.receiver or transaction.input_transaction_hashes == ["0"]:
+                    continue
+                candidates.append(unlabeled(transaction))
+        candidates.extend(self.entries.values())
+
+        self.entries = OrderedDict()
+        self.spenders = {}
+        self.tip = ledger.current_block_hash()
+        self.template.reset([])
+        for transaction in candidates:
+            if transaction.signed_hash() not in mined:
+                self.add(transaction, verified=True)
+
+
+#Copy of a transaction taken out of a block, as it was before the block labeled it
+def unlabeled(transaction):
+    transaction = copy.copy(transaction)
+    transaction.block = -1
+    transaction.number = -1
+    transaction.hash = -1
+    return transaction
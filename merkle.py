@@ -0,0 +1,94 @@
+"""
+
+Merkle trees over the transaction hashes of a block
+
+Leaves and inner nodes are hashed with different prefixes so a leaf can not pass
+for an inner node. A level with an odd number of nodes moves its last node up a
+level unchanged, so no transaction is ever paired with itself. A proof is the
+list of sibling hashes from a transaction up to the root, each marked with the
+side the sibling is on.
+
+"""
+
+import hashlib
+
+LEAF = b"\x00"
+NODE = b"\x01"
+
+#Root of a block without transactions
+EMPTY_ROOT = hashlib.sha256(b"").digest()
+
+def leaf_hash(transaction_hash):
+    return hashlib.sha256(LEAF + bytes.fromhex(transaction_hash)).digest()
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE + left + right).digest()
+
+class MerkleBuilder:
+    """ Root of a list of transaction hashes built one hash at a time
+
+    Only the roots of the complete subtrees are kept, largest first, so adding a
+    hash costs one hash call on average and the root is found in log time.
+    """
+
+    def __init__ (self):
+        #[number of leaves, root] of each complete subtree
+        self.peaks = []
+
+    def add(self, transaction_hash):
+        size, digest = 1, leaf_hash(transaction_hash)
+        while len(self.peaks) > 0 and self.peaks[-1][0] == size:
+            left_size, left = self.peaks.pop()
+            size, digest = size + left_size, node_hash(left, digest)
+        self.peaks.append((size, digest))
+
+    def copy(self):
+        builder = MerkleBuilder()
+        builder.peaks = list(self.peaks)
+        return builder
+
+    def root(self):
+        if len(self.peaks) == 0:
+            return EMPTY_ROOT
+        digest = self.peaks[-1][1]
+        for size, peak in reversed(self.peaks[:-1]):
+            digest = node_hash(peak, digest)
+        return digest
+
+def merkle_root(transaction_hashes):
+    builder = MerkleBuilder()
+    for transaction_hash in transaction_hashes:
+        builder.add(transaction_hash)
+    return builder.root()
+
+def merkle_proof(transaction_hashes, position):
+    """ Proof that the hash at position is in the tree, a list of ["L" or "R", sibling hash as hex] """
+    level = [leaf_hash(transaction_hash) for transaction_hash in transaction_hashes]
+    proof = []
+    while len(level) > 1:
+        if position % 2 == 1:
+            proof.append(["L", level[position - 1].hex()])
+        elif position + 1 < len(level):
+            proof.append(["R", level[position + 1].hex()])
+        level = [node_hash(level[index], level[index + 1]) if index + 1 < len(level) else level[index]
+            for index in range(0, len(level), 2)]
+        position = position // 2
+    return proof
+
+def proof_root(transaction_hash, proof):
+    """ Root a proof leads to from a transaction hash, None if the proof is malformed """
+    try:
+        digest = leaf_hash(transaction_hash)
+        for side, sibling in proof:
+            if side == "L":
+                digest = node_hash(bytes.fromhex(sibling), digest)
+            elif side == "R":
+                digest = node_hash(digest, bytes.fromhex(sibling))
+            else:
+                return None
+    except (ValueError, TypeError):
+        return None
+    return digest
+
+def verify_proof(transaction_hash, proof, root):
+    return proof_root(transaction_hash, proof) == root
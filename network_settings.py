@@ -5,4 +5,13 @@ Constants for networking
 """
 
 PEER_LIST_SIZE = 1
-POW_DIFFICULTY = 6
\ No newline at end of file
+POW_DIFFICULTY = 6
+
+#Worker processes used for mining, None uses every core
+POW_PROCESSES = None
+
+#Seconds before a block request is sent to another peer
+REQUEST_TIMEOUT = 10
+
+#Seconds between pings used to measure peer latency
+PING_INTERVAL = 30
@@ -3,20 +3,32 @@ Protocols and classes for running a node on the network
 """
 
 
-from coin import Ledger, Block, Transaction
-import pickle
-import hashlib
+from coin import Transaction, parse_amount, format_amount
 import helper
+import signatures
+import wire
+import sync
+import snapshot
+from sync import BlockSync
+from history import HistorySync
+from gossip import Gossip
+from mempool import Mempool
+from validation import ValidationPipeline
 from twisted.internet.protocol import Factory, ClientFactory
 from twisted.protocols.basic import LineReceiver
 from twisted.internet import threads, reactor, stdio
 from twisted.internet.task import LoopingCall
-import json
 import nacl.encoding
 import nacl.signing
-from decimal import *
 from collections import deque
-from POW import find_nonce_random_start
+from POW import Miner
+from blockstore import save_ledger, StoredBlocks
+
+#Latency assumed for a peer until it has answered
+DEFAULT_LATENCY = 1.0
+
+#Commands whose blocks are decoded and checked on worker threads before they are handled
+CHECKED_COMMANDS = ("newBlock", "getBlock", "syncBlock", "historyBlock")
 
 def nodeID(addr):
     """Helper function to create nodeid"""
@@ -27,43 +39,100 @@ def nodeID(addr):
 class NodeProtocol(LineReceiver):
     """ Protocol for each individual peer connection """
 
+    #Blocks are sent as single lines to peers that only speak JSON
+    MAX_LENGTH = wire.MAX_FRAME
+
     def __init__(self, addr, factory):
         self.state = "NEW"
         self.addr = addr
         self.factory = factory
+        self.binary = False
+        self.features = []
+        self.frame_buffer = bytearray()
+        #Height the peer has shown us and smoothed round trip time in seconds
+        self.height = -1
+        self.latency = DEFAULT_LATENCY
+        self.ping_time = None
 
     def connectionMade(self):
         self.state = "CONNECTED"
         #self.sendLine(b"connected")
         print("connected")
+        #Only nodes that hold their whole chain serve history
+        features = [feature for feature in wire.FEATURES if feature != "history" or self.factory.ledger.first_height() == 0]
+        self.sendData("version", {"features": features, "height": self.factory.ledger.current_block_number()})
 
     def connectionLost(self, reason):
         self.state = "OLD"
+        self.factory.sync.peerLost(self)
+
+    def encode(self, code, data):
+        """ Encode a message in the format this peer reads, binary frames once negotiated """
+        if self.binary:
+            return wire.encode_frame(code, data)
+        return wire.encode_line(code, data) + self.delimiter
+
+    def sendEncoded(self, message):
+        self.transport.write(message)
 
     def sendData(self, code, data):
-        message_data = [code, data]
-        message = json.dumps(message_data)
-        self.sendLine(message.encode("ascii"))
+        self.sendEncoded(self.encode(code, data))
 
     def sendPing(self):
+        self.ping_time = self.factory.reactor.seconds()
         self.sendData("ping", "")
 
+    def recordLatency(self, seconds):
+        self.latency = 0.8 * self.latency + 0.2 * seconds
+
+    def seenHeight(self, height):
+        """ The peer has shown it has a block at height """
+        if isinstance(height, int) and height > self.height:
+            self.height = height
+
     def requestPeers(self):
         """ Request peer list from another node """
         self.sendData("sendPeers", "")
 
     def lineReceived(self, line):
-        line = line.decode("ascii")
-        message = json.loads(line)
-        
+        if wire.line_command(line) in CHECKED_COMMANDS:
+            self.factory.validation.submit(wire.decode_line, line, self.blockChecked)
+            return
+        try:
+            command, data = wire.decode_line(line)
+        except Exception as e:
+            return
+        self.dispatch(command, data)
 
+    def rawDataReceived(self, data):
+        """ Binary frames, used once the peer has sent its binary line """
+        self.frame_buffer += data
+        try:
+            frames = wire.read_frames(self.frame_buffer)
+        except wire.WireError as e:
+            print(e)
+            self.transport.loseConnection()
+            return
+        for frame in frames:
+            if wire.frame_command(frame) in CHECKED_COMMANDS:
+                self.factory.validation.submit(wire.decode_frame, frame, self.blockChecked)
+                continue
+            try:
+                command, data = wire.decode_frame(frame)
+            except Exception as e:
+                continue
+            self.dispatch(command, data)
+
+    def blockChecked(self, result):
+        """ A block back from the validation pipeline, blocks that failed its checks are dropped """
+        command, block, checked = result
+        if checked:
+            self.dispatch(command, block)
+
+    def dispatch(self, command, data):
         # Dispatch the command to the appropriate method.  Note that all you
         # need to do to implement a new command is add another do_* method.
-        command = message[0]
-        data = message[1]
         #print("message_received: " + command)
-
-
         try:
             method = getattr(self, 'do_' + command)
         except:
@@ -74,40 +143,120 @@ class NodeProtocol(LineReceiver):
             except Exception as e:
                 pass
 
+    def do_version(self, data):
+        """ Peer announced its features and height, switch our output to binary frames if it reads them """
+        features = data["features"]
+        self.features = features
+        self.seenHeight(data["height"])
+        if "binary" in features and not self.binary:
+            self.sendData("binary", "")
+            self.binary = True
+        if "headers" in features:
+            self.factory.sync.requestHeaders(self)
+
+    def do_binary(self, data):
+        """ Everything the peer sends after this line is binary frames """
+        self.setRawMode()
+
     def do_newBlock(self, data):
-        self.factory.newBlockExcept(data, self.addr.host)
+        #Blocks reach here through blockChecked
+        self.seenHeight(data.block_number)
+        self.factory.newBlockExcept(data, self, checked=True)
 
     def do_getBlock(self, data):
+        #Blocks reach here through blockChecked
+        self.seenHeight(data.block_number)
+        self.factory.blockReplied(self, data)
         self.factory.newBlockNoSend(data)
 
     def do_returnNextBlock(self, hash_value):
         """ Return the next block after the provided hash """
+        height = self.factory.ledger.height_of(hash_value)
+        if height is not None and height + 1 < len(self.factory.ledger.blocks):
+            self.sendBlock(height + 1)
 
-        break_next_cycle = False
+    def do_returnBlock(self, hash_value):
+        """ Return the block with the provided hash """
+        height = self.factory.ledger.height_of(hash_value)
+        if height is not None:
+            self.sendBlock(height)
+
+    def do_getHeaders(self, data):
+        """ Return the hashes of our blocks after the newest one in the peer's locator """
+        locator_hashes, limit = data
+        self.sendData("headers", sync.headers_after(self.factory.ledger, locator_hashes, limit))
+
+    def do_headers(self, data):
+        start_height, hashes = data
+        self.seenHeight(start_height + len(hashes) - 1)
+        self.factory.sync.receiveHeaders(self, data)
+
+    def do_getBlocks(self, hashes):
+        """ Return a batch of blocks for a peer that is syncing """
+        for block_hash in hashes[:sync.BATCH_SIZE]:
+            height = self.factory.ledger.height_of(block_hash)
+            if height is not None:
+                self.sendBlock(height, "syncBlock")
+
+    def do_getProof(self, data):
+        """ Return the header of a block and the Merkle proof that a transaction is in it, see Block.check_proof """
+        block_hash, transaction_hash = data
+        height = self.factory.ledger.height_of(block_hash)
+        if height is None:
+            return
+        block = self.factory.ledger.blocks[height]
+        for position, transaction in enumerate(block.transactions):
+            if transaction.hash == transaction_hash:
+                self.sendData("proof", block.proof(position))
+                return
 
-        for block in self.factory.ledger.blocks:
-            if break_next_cycle == True:
-                """Breaking cycle"""
-                self.sendData("getBlock", block.dump())
-                break
-            elif block.hash == hash_value:
-                break_next_cycle = True
+    def do_syncBlock(self, block):
+        self.factory.sync.receiveBlock(self, block)
 
-    def do_returnBlock(self, hash_value):
-        """ Return the next block after the provided hash, this can be improved to be less cumbersom
-                maybe dictionary for finding specific hashes quickly
-         """
+    def do_getHistory(self, data):
+        """ Return the blocks we hold of a run of heights, for a peer checking the history under its snapshot """
+        start_height, count = data
+        ledger = self.factory.ledger
+        for height in range(max(start_height, 0), min(start_height + min(count, sync.BATCH_SIZE), len(ledger.blocks))):
+            #Blocks that were pruned or are still under our own snapshot are left out
+            try:
+                self.sendBlock(height, "historyBlock")
+            except IndexError:
+                continue
+
+    def do_historyBlock(self, block):
+        self.factory.history.receiveBlock(self, block)
+
+    def sendBlock(self, height, code="getBlock"):
+        """ Send the block at height, stored blocks are sent as they are on disk in either format """
+        blocks = self.factory.ledger.blocks
+        if isinstance(blocks, StoredBlocks):
+            view = blocks.view(height)
+            if not self.binary:
+                self.sendRecord(code, view.record())
+                return
+            payload = view.payload()
+            if payload is not None:
+                self.sendPayload(code, payload)
+                return
+        self.sendData(code, blocks[height])
+
+    def sendRecord(self, code, record):
+        """ Send data that is already JSON encoded, record can be a memoryview of the block store """
+        self.transport.writeSequence([b'["' + code.encode("ascii") + b'", ', record, b']' + self.delimiter])
 
-        for block in self.factory.ledger.blocks:
-            if block.hash == hash_value:
-                self.sendData("getBlock", block.dump())
+    def sendPayload(self, code, payload):
+        """ Send a frame whose payload is already encoded, payload can be a memoryview of the block store """
+        self.transport.writeSequence([wire.frame_header(code, len(payload)), payload])
     
     def do_ping(self, data):
         self.sendData("pong", "")
     
     def do_pong(self, data):
         #Make this mark the peer for no deletion
-        pass
+        if self.ping_time is not None:
+            self.recordLatency(self.factory.reactor.seconds() - self.ping_time)
+            self.ping_time = None
 
     def do_sendPeers(self,data):
         """ Respond to a request for a peer list """
@@ -127,7 +276,14 @@ class NodeProtocol(LineReceiver):
 
     def do_transaction(self, data):
         """ Receive a new transaction """
-        self.factory.receiveTransaction(data, self.addr.host)
+        self.factory.receiveTransaction(data, self)
+
+    def do_inv(self, items):
+        """ Peer announced [kind, hash] pairs of blocks and transactions it has """
+        self.factory.gossip.receiveInv(self, items)
+
+    def do_getData(self, items):
+        self.factory.gossip.receiveGetData(self, items)
 
 class CommandProtocol(LineReceiver):
     """Protocol for receiving input from the command line"""
@@ -181,11 +337,11 @@ class CommandProtocol(LineReceiver):
 
     def do_balance(self):
         """Return balance of an address"""
-        self.sendLine(b"Balance: " + str(self.factory.balance(self.factory.my_address)).encode('ascii'))
+        self.sendLine(b"Balance: " + format_amount(self.factory.balance(self.factory.my_address)).encode('ascii'))
         
     def do_send(self, value, address):
         """Send value ammount"""
-        value = Decimal(value)
+        value = parse_amount(value)
         if value == 0:
             self.sendLine(b"Transaction must be non-zero")
             return
@@ -194,14 +350,19 @@ class CommandProtocol(LineReceiver):
         total = 0
         input_transactions = []
         for unspent in unspent_transactions:
+            #Outputs spent by our pending transactions are not offered again
+            if self.factory.mempool.spender(unspent.hash) is not None:
+                continue
             total = total + unspent.value
             input_transactions.append(unspent.hash)
             if total >= value:
                 new_transaction = Transaction(input_transactions, value, self.factory.my_address, address)
-                signature = self.factory.signing_key.sign(new_transaction.verify_dump().encode("ascii"), encoder=nacl.encoding.HexEncoder).signature
+                signature = self.factory.signing_key.sign(new_transaction.signed_bytes(), encoder=nacl.encoding.HexEncoder).signature
                 new_transaction.sign(signature)
-                self.factory.new_transactions.add(new_transaction)
-                self.factory.sendPeers("transaction", new_transaction.dump())
+                if self.factory.mempool.add(new_transaction):
+                    self.factory.gossip.relay("tx", new_transaction)
+                else:
+                    self.sendLine(b"Transaction rejected by the mempool")
                 return
         self.sendLine(b"Insufficient balance")
 
@@ -222,6 +383,9 @@ class CommandProtocol(LineReceiver):
         """ Check current status of the node """
         self.sendLine(str(self.factory.ledger.current_block_number()).encode('UTF-8'))
         self.sendLine(str(self.factory.ledger.current_block_hash()).encode('UTF-8'))
+        self.sendLine(b"Hash rate: " + str(int(self.factory.miner.hash_rate())).encode('UTF-8') + b" H/s")
+        hits, misses = signatures.cache_stats()
+        self.sendLine(("Signature cache: " + str(hits) + " hits, " + str(misses) + " misses").encode('UTF-8'))
 
     def do_get(self):
         """ For testing, allows me to request the next block """
@@ -246,14 +410,23 @@ class CommandProtocol(LineReceiver):
         """ test command for debugging current problem """
         self.factory.requestPeers()
 
+    def do_snapshot(self, path="snapshot.dat"):
+        """snapshot [path]: Write the unspent set at the tip to a file new nodes can start from"""
+        try:
+            snapshot.write_snapshot(self.factory.ledger, path)
+        except ValueError as e:
+            self.sendLine(b"Could not write snapshot: " + str(e).encode("ascii"))
+            return
+        self.sendLine(b"Wrote snapshot at block " + str(self.factory.ledger.current_block_number()).encode("ascii"))
+
     def do_save(self):
-        pickle.dump(self.factory.ledger, open( "peer_ledger.p", "wb" ))
+        """ Save the ledger indexes so the next start opens without replaying the chain """
+        save_ledger(self.factory.ledger, "peer_ledger.p")
 
 
 class NodeFactory(ClientFactory):
     def __init__(self, input_reactor, ledger, my_address, 
         signing_key, PEER_PORT, MY_IP, NETWORK_SETTINGS):
-        self.new_transactions = set()
         self.peers = {}
         self.reactor = input_reactor
         self.ledger = ledger
@@ -264,17 +437,40 @@ class NodeFactory(ClientFactory):
         self.peers_ip_list = [MY_IP]
         self.ns = NETWORK_SETTINGS
         self.block_buffer = deque()
+        self.miner = Miner(self.ns.POW_PROCESSES)
+        self.sync = BlockSync(self)
+        self.history = HistorySync(self)
+        self.gossip = Gossip(self)
+        self.mempool = Mempool(ledger, my_address)
+        self.validation = ValidationPipeline(self.deferToThread)
+        self.d = None
+        #(command, block hash) -> [peer, time sent, peers tried, minimum height]
+        self.requests = {}
+        self.history.start()
+
+    def deferToThread(self, function, *args):
+        """ Run function on a worker thread and return a Deferred of its result, asyncio_node runs it on the loop's executor """
+        return threads.deferToThread(function, *args)
 
     def startPOW(self):
-        f = find_nonce_random_start
-        self.d = threads.deferToThread(f, self.ledger.current_block_hash(), self.ns.POW_DIFFICULTY)
-        self.d.addCallbacks(self.update, errback=(lambda x : print("cancelled")))
+        self.miner.start()
+        self.d = self.deferToThread(self.miner.mine, self.ledger.current_block_hash(), self.ns.POW_DIFFICULTY)
+        self.d.addCallbacks(self.nonceFound, errback=(lambda x : print("cancelled")))
 
     def resetPOW(self):
+        """ The tip changed, update the mempool and mine on the new tip """
+        self.mempool.refresh()
+        #Mining has not started yet, startPOW will use the new tip
+        if self.d is None:
+            return
+        self.miner.cancel()
         self.d.cancel()
-        f = find_nonce_random_start
-        self.d = threads.deferToThread(f, self.ledger.current_block_hash(), self.ns.POW_DIFFICULTY)
-        self.d.addCallbacks(self.update, errback=(lambda x : print("cancelled")))
+        self.startPOW()
+
+    def nonceFound(self, nonce):
+        """ Callback for the miner, None means the search was cancelled """
+        if nonce is not None:
+            self.update(nonce)
 
     def buildProtocol(self, addr):
         if addr.host not in self.peers_ip_list:
@@ -291,89 +487,109 @@ class NodeFactory(ClientFactory):
         """ Output a message through the command line """
         self.cmd_line.sendLine(msg.encode("ascii"))
 
-    def receiveTransaction(self, transaction, do_not_send_peer):
-        new_transaction = Transaction.from_json(transaction)
-        if(transaction not in self.new_transactions):
-            print("received transaction")
-            self.new_transactions.add(new_transaction)
-            self.sendPeersExcept("transaction", transaction.dump(), do_not_send_peer)
-            
+    def receiveTransaction(self, transaction, peer=None):
+        """ Keep a new transaction for the next block and pass it on to every peer except peer, usually the sender """
+        if self.gossip.received("tx", transaction) == False:
+            return
+        if self.mempool.add(transaction) == False:
+            self.gossip.rejected("tx", transaction)
+            return
+        print("received transaction")
+        self.gossip.relay("tx", transaction, peer)
+
 
     def balance(self, address):
         """ Return the balance of an address """
         return self.ledger.check_balance(address)
 
     def update(self, nonce):
-        """ Add a new block to the ledger will be replace with mining """
-        new_block = Block(list(self.new_transactions), self.my_address, self.ledger.current_block_hash(), nonce)
-        if self.ledger.update(new_block):
-            self.sendPeers("newBlock", new_block.dump())
-            print("sent block")
-            self.startPOW()
-        else:
-            print("Invalid block")   
-        self.new_transactions.clear()
-
-    def newBlockExcept(self, block, do_not_send_peer):
-        """ Send block to everyone except do_not_send_peer, usually the sender """
+        """ Seal the block template with a nonce found for the tip, add the block to the ledger and announce it """
+        new_block = self.mempool.block_template().seal(nonce)
+        if self.ledger.extends_tip(new_block) == False:
+            print("Invalid block")
+            return
+        #Announced once it is in the ledger, so peers asking for it right away are served and a failed append is not relayed
+        self.ledger.append_block(new_block)
+        print("Created block " + str(new_block.block_number))
+        self.gossip.relay("block", new_block)
+        print("sent block")
+        self.mempool.refresh()
+        self.startPOW()
+
+    def newBlockExcept(self, block, peer=None, checked=False):
+        """ Send block to everyone except peer, usually the sender, blocks seen before are ignored
+
+        checked means the validation pipeline already ran the checks that do not need the ledger.
+        """
         try:
-            block = Block.from_json(block)
+            if self.gossip.received("block", block) == False:
+                return
             print("recieved block " + str(block.block_number))
             if block.prev_hash == self.ledger.current_block_hash():
-                if self.ledger.add(block):
+                if self.ledger.add(block, checked):
                     print("added block " + str(block.block_number))
-                    self.sendPeersExcept("newBlock", block.dump(), do_not_send_peer)
+                    self.gossip.relay("block", block, peer)
                     self.resetPOW()
+            elif self.ledger.knows(block.prev_hash):
+                #A block of a competing branch, the chain switches to it once it has more work
+                tip = self.ledger.current_block_hash()
+                if self.ledger.accept(block, checked):
+                    self.gossip.relay("block", block, peer)
+                    if self.ledger.current_block_hash() != tip:
+                        print("switched to a branch now at block " + str(self.ledger.current_block_number()))
+                        self.resetPOW()
             elif block.block_number > self.ledger.current_block_number():
-                if len(self.block_buffer) == 0 :
-                    self.d.pause
+                #Peers that serve headers are synced from, others are walked back one block at a time
+                if peer is not None and "headers" in peer.features:
+                    self.sync.requestHeaders(peer)
+                elif len(self.block_buffer) == 0 :
                     self.block_buffer.append(block)
-                    self.getBlock(block.prev_hash)
+                    self.getBlock(block.prev_hash, block.block_number - 1)
                 elif self.block_buffer[-1].hash == block.prev_hash:
                     self.block_buffer.appendleft(block)
-            self.new_transactions.clear()
+            self.mempool.refresh()
         except Exception as e:
             print(e)
 
     def newBlockNoSend (self, block):
-        """ Receive a block and do not send it, useful when asking for older blocks """
+        """ Receive a block and do not send it, useful when asking for older blocks
+
+        Blocks of the buffer came through the validation pipeline, only the ledger checks are left.
+        """
         
         try:
-            block = Block.from_json(block)
-
             #Add block to buffer list if it fits
             if block.hash == self.block_buffer[-1].prev_hash:
                 self.block_buffer.append(block)
 
-                #Check if this is the next block in sequence
-                if block.prev_hash == self.ledger.current_block_hash():
-                    if self.ledger.add_buffer(self.block_buffer):
-                        print("Received block buffer now at block " + str(self.ledger.current_block_number()))
-                        self.resetPOW()
-                    self.block_buffer.clear()
-
-                elif self.ledger.is_root(block):
-                    if self.ledger.add_buffer(self.block_buffer):
+                #Check if the buffer joins the chain or a branch competing with it
+                if self.ledger.knows(block.prev_hash):
+                    if self.ledger.add_buffer(self.block_buffer, checked=True):
                         print("Received block buffer now at block " + str(self.ledger.current_block_number()))
                         self.resetPOW()
                     self.block_buffer.clear()
 
                 else:
-                    self.getBlock(block.prev_hash)
+                    self.getBlock(block.prev_hash, block.block_number - 1)
 
-            self.new_transactions.clear()
+            self.mempool.refresh()
         except Exception as e:
             print(e)
    
     def sendPeers(self, code, data):
-        for peer in self.peers:
-            self.peers[peer].sendData(code, data)
+        self.sendPeersExcept(code, data, None)
 
     def sendPeersExcept(self, code, data, do_not_send_peer):
-        """ Send data to all peers except one, this is usually the sender """
-        for peer in self.peers:
-            if peer != do_not_send_peer:
-                self.peers[peer].sendData(code, data)
+        """ Send data to all peers except one protocol, this is usually the sender
+
+        The message is encoded once for JSON peers and once for binary peers.
+        """
+        encoded = {}
+        for protocol in self.peers.values():
+            if protocol is not do_not_send_peer:
+                if protocol.binary not in encoded:
+                    encoded[protocol.binary] = protocol.encode(code, data)
+                protocol.sendEncoded(encoded[protocol.binary])
 
     def listPeers(self):
         for peer in self.peers:
@@ -381,10 +597,50 @@ class NodeFactory(ClientFactory):
 
     def getNextBlock(self):
         """ Requests next block """
-        self.sendPeers("returnNextBlock", self.ledger.current_block_hash())
+        self.request("returnNextBlock", self.ledger.current_block_hash(), self.ledger.current_block_number() + 1)
+
+    def getBlock(self, block_hash, height=0):
+        self.request("returnBlock", block_hash, height)
+
+    def choosePeer(self, min_height=0, exclude=()):
+        """ The connected peer with the lowest latency that has shown a block at min_height
+
+        Peers whose height we have not learned yet are only used when no peer is known to be high enough.
+        """
+        peers = [peer for peer in self.peers.values() if peer.state == "CONNECTED" and peer not in exclude]
+        able = [peer for peer in peers if peer.height >= min_height]
+        if len(able) == 0:
+            able = [peer for peer in peers if peer.height < min_height]
+        if len(able) == 0:
+            return None
+        return min(able, key=lambda peer: peer.latency)
+
+    def request(self, code, block_hash, min_height, tried=frozenset()):
+        """ Ask one peer for a block, another peer is asked if it does not answer in time """
+        key = (code, block_hash)
+        peer = self.choosePeer(min_height, tried)
+        if peer is None:
+            self.requests.pop(key, None)
+            return
+        self.requests[key] = [peer, self.reactor.seconds(), tried | {peer}, min_height]
+        peer.sendData(code, block_hash)
+        self.reactor.callLater(self.ns.REQUEST_TIMEOUT, self.requestTimeout, key, peer)
 
-    def getBlock(self, block_hash):
-        self.sendPeers("returnBlock", block_hash)
+    def requestTimeout(self, key, peer):
+        entry = self.requests.get(key)
+        if entry is None or entry[0] is not peer:
+            return
+        peer.recordLatency(self.ns.REQUEST_TIMEOUT)
+        self.request(key[0], key[1], entry[3], entry[2])
+
+    def blockReplied(self, peer, block):
+        """ Clear the request a getBlock reply answers """
+        for key in (("returnBlock", block.hash), ("returnNextBlock", block.prev_hash)):
+            entry = self.requests.get(key)
+            if entry is not None:
+                del self.requests[key]
+                if entry[0] is peer:
+                    peer.recordLatency(self.reactor.seconds() - entry[1])
 
     def pingPeers(self):
         for peer in self.peers:
@@ -0,0 +1,116 @@
+"""
+
+Packed columnar form of blocks, used for the history blockstore.StoredBlocks keeps in memory
+
+A PackedBlock keeps the transactions of a block as columns instead of Transaction
+objects: signatures and input hashes as the raw bytes Transaction holds them in,
+senders and receivers as numbers into the block's table of keys, and values as
+integers. Transaction hashes are not stored, the transactions are hashed again
+when the block is unpacked, so a transaction is only packed if that gives back
+its hash. The few transactions that do not fit the columns, like the reward of
+each block, stay objects.
+
+"""
+
+import array
+import copy
+import coin
+
+#Transactions and blocks with fields that fit the columns, larger ones stay objects
+MAX_INPUTS = 2**16
+MAX_NUMBER = 2**32
+
+class PackedBlock:
+    __slots__ = ("header", "count", "others", "keys", "senders", "receivers", "signatures", "inputs",
+        "input_counts", "values", "numbers", "versions")
+
+    def __init__ (self, block):
+        self.header = (block.timestamp, block.raw_processor, block.raw_prev_hash, block.raw_hash, block.block_number,
+            block.nonce, block.POW_difficulty, block.version)
+        self.count = len(block.transactions)
+        #position in the block -> transaction that does not fit the columns
+        self.others = {}
+
+        key_numbers = {}
+        signatures = bytearray()
+        inputs = bytearray()
+        senders = []
+        receivers = []
+        self.input_counts = array.array("H")
+        self.values = array.array("q")
+        self.numbers = array.array("I")
+        self.versions = array.array("B")
+        for position, transaction in enumerate(block.transactions):
+            if not fits(transaction, block.block_number):
+                self.others[position] = transaction
+                continue
+            senders.append(key_numbers.setdefault(transaction.raw_sender, len(key_numbers)))
+            receivers.append(key_numbers.setdefault(transaction.raw_receiver, len(key_numbers)))
+            signatures += transaction.raw_signature
+            inputs += transaction.raw_inputs
+            self.input_counts.append(len(transaction.raw_inputs) // 32)
+            self.values.append(transaction.value)
+            self.numbers.append(transaction.number)
+            self.versions.append(transaction.version)
+        typecode = "H" if len(key_numbers) < 2**16 else "I"
+        self.senders = array.array(typecode, senders)
+        self.receivers = array.array(typecode, receivers)
+        self.keys = b"".join(key_numbers)
+        self.signatures = bytes(signatures)
+        self.inputs = bytes(inputs)
+
+    def unpack(self):
+        """ Return the block as objects, the transactions are hashed again """
+        timestamp, processor, prev_hash, block_hash, block_number, nonce, POW_difficulty, version = self.header
+        transactions = []
+        column = 0
+        start = 0
+        for position in range(self.count):
+            if position in self.others:
+                transactions.append(copy.copy(self.others[position]))
+                continue
+            end = start + 32 * self.input_counts[column]
+            sender = 32 * self.senders[column]
+            receiver = 32 * self.receivers[column]
+            transaction = coin.Transaction.from_raw(self.inputs[start:end], self.values[column],
+                self.keys[sender:sender + 32], self.keys[receiver:receiver + 32])
+            transaction.block = block_number
+            transaction.number = self.numbers[column]
+            transaction.raw_signature = self.signatures[64 * column:64 * column + 64]
+            transaction.version = self.versions[column]
+            transaction.set_hash()
+            transactions.append(transaction)
+            start = end
+            column = column + 1
+
+        block = coin.Block.__new__(coin.Block)
+        block.timestamp = timestamp
+        block.transactions = transactions
+        block.raw_processor = processor
+        block.block_number = block_number
+        block.raw_prev_hash = prev_hash
+        block.raw_hash = block_hash
+        block.nonce = nonce
+        block.POW_difficulty = POW_difficulty
+        block.version = version
+        return block
+
+def fits(transaction, height):
+    """ True if a transaction can be unpacked from the columns as an identical transaction """
+    if type(transaction.raw_sender) is not bytes or type(transaction.raw_receiver) is not bytes:
+        return False
+    if type(transaction.raw_signature) is not bytes or type(transaction.raw_inputs) is not bytes:
+        return False
+    if len(transaction.raw_inputs) // 32 >= MAX_INPUTS or transaction.value_text is not None:
+        return False
+    if type(transaction.value) is not int or not -2**63 <= transaction.value < 2**63:
+        return False
+    if transaction.block != height or type(transaction.number) is not int or not 0 <= transaction.number < MAX_NUMBER:
+        return False
+    if type(transaction.input_value) is not int or transaction.input_value != 0 or not 0 < transaction.version < 256:
+        return False
+
+    #Unpacking hashes the transaction again, keep it whole if that would give another hash
+    check = copy.copy(transaction)
+    check.set_hash()
+    return check.raw_hash == transaction.raw_hash
@@ -0,0 +1,129 @@
+"""
+
+Signature checks for transactions, done for a whole block at a time
+
+Good signatures are remembered by the transaction's signed hash, which covers the
+sender, the signed message and the signature, so a transaction seen again in a
+block, or again during a reorg, is not checked twice. The cache is looked up
+before any key or message is built.
+
+"""
+
+import os
+import threading
+import nacl.signing
+import nacl.encoding
+import nacl.exceptions
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+#Number of senders whose VerifyKey is kept
+KEY_CACHE_SIZE = 4096
+
+#Threads checking signatures, PyNaCl releases the GIL while it verifies
+VERIFY_THREADS = os.cpu_count() or 1
+
+#Number of verified signatures remembered
+VERIFIED_CACHE_SIZE = 65536
+
+#Batches smaller than this are checked on the calling thread
+MIN_PARALLEL = 64
+
+verify_keys = OrderedDict()
+verify_keys_lock = threading.Lock()
+verified = OrderedDict()
+verified_lock = threading.Lock()
+cache_hits = 0
+cache_misses = 0
+pool = None
+
+def verify_key(sender):
+    """ Return the cached VerifyKey for a hex encoded sender, None if it is not a valid key """
+    with verify_keys_lock:
+        if sender in verify_keys:
+            verify_keys.move_to_end(sender)
+            return verify_keys[sender]
+    try:
+        key = nacl.signing.VerifyKey(sender, encoder=nacl.encoding.HexEncoder)
+    except (ValueError, TypeError):
+        key = None
+    with verify_keys_lock:
+        verify_keys[sender] = key
+        if len(verify_keys) > KEY_CACHE_SIZE:
+            verify_keys.popitem(last=False)
+    return key
+
+#Key of a transaction in the verified cache, None if its fields can not be encoded
+def cache_key(transaction):
+    try:
+        return transaction.signed_hash()
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+#Collect what is needed to check a transaction, done on the calling thread
+def prepare(transaction):
+    try:
+        signature = bytes.fromhex(transaction.signature.decode("ascii"))
+        return (verify_key(transaction.sender), transaction.signed_bytes(), signature)
+    except (ValueError, TypeError, AttributeError):
+        return (None, None, None)
+
+def check(key, message, signature):
+    if key is None:
+        return False
+    try:
+        key.verify(message, signature)
+    except (nacl.exceptions.BadSignatureError, ValueError, TypeError):
+        return False
+    return True
+
+def check_batch(batch):
+    return [check(key, message, signature) for key, message, signature in batch]
+
+def verify_transaction(transaction):
+    return verify_transactions([transaction])[0]
+
+def verify_transactions(transactions):
+    """ Check the signatures of a list of transactions, returns a list of results in the same order
+
+    Signatures found in the cache pass straight away, large batches of the rest
+    are split across a pool of threads.
+    """
+    global pool, cache_hits, cache_misses
+    results = [True] * len(transactions)
+    pending = []
+    entries = []
+    with verified_lock:
+        for position, transaction in enumerate(transactions):
+            entry = cache_key(transaction)
+            if entry is not None and entry in verified:
+                verified.move_to_end(entry)
+                cache_hits = cache_hits + 1
+                continue
+            cache_misses = cache_misses + 1
+            pending.append(position)
+            entries.append(entry)
+
+    batch = [prepare(transactions[position]) for position in pending]
+    if len(batch) < MIN_PARALLEL or VERIFY_THREADS == 1:
+        checked = check_batch(batch)
+    else:
+        if pool is None:
+            pool = ThreadPoolExecutor(VERIFY_THREADS)
+        size = -(-len(batch) // VERIFY_THREADS)
+        checked = []
+        for part in pool.map(check_batch, [batch[start:start + size] for start in range(0, len(batch), size)]):
+            checked.extend(part)
+
+    with verified_lock:
+        for position, entry, valid in zip(pending, entries, checked):
+            results[position] = valid
+            if valid and entry is not None:
+                verified[entry] = None
+                if len(verified) > VERIFIED_CACHE_SIZE:
+                    verified.popitem(last=False)
+    return results
+
+def cache_stats():
+    """ Return (hits, misses) of the verified signature cache """
+    return (cache_hits, cache_misses)
@@ -0,0 +1,220 @@
+"""
+
+UTXO snapshots for starting a node without replaying the chain
+
+A snapshot holds the unspent set and address balances of a ledger after one
+block, with the digest of that state and the hash of the block it was taken at.
+A node started from one has the snapshot block as the oldest block of its chain
+and validates and mines on top of it straight away, while history.HistorySync
+fetches the blocks under it from genesis up. When the blocks under it rebuild
+the state the snapshot committed to, the ledger switches to the full chain.
+
+"python snapshot.py ledger snapshot.dat" writes a snapshot of the chain stored in
+the directory ledger, new nodes start from it with "python xcoin.py --snapshot
+snapshot.dat". A running node writes one with the snapshot console command.
+
+The file is JSON lines: a header, the genesis block, the snapshot block, then
+one line for each unspent transaction and each address balance.
+
+"""
+
+import copy
+import json
+import hashlib
+import os
+import sys
+import coin
+import helper
+from utxo import UnspentSet
+from index import AddressIndex
+
+SNAPSHOT_VERSION = 1
+
+#Snapshot a node started from, kept in its block store directory until its history is checked
+PENDING_FILE = "snapshot.dat"
+
+def state_digest(unspent, balances):
+    """ Digest of an unspent set and address balances, the same whatever order the state was built in """
+    digest = hashlib.sha256()
+    for line in sorted(output_line(transaction_hash, entry[1]) for transaction_hash, entry in unspent.outputs.items()):
+        digest.update(line + b"\n")
+    digest.update(b"\n")
+    for line in sorted(balance_line(address, balance) for address, balance in balances.items() if balance != 0):
+        digest.update(line + b"\n")
+    return digest.hexdigest()
+
+#Transaction hashes commit to the rest of the transaction, read_snapshot checks they do
+def output_line(transaction_hash, remaining):
+    return json.dumps([transaction_hash, remaining]).encode("ascii")
+
+def balance_line(address, balance):
+    return json.dumps([coin.to_text(address), balance]).encode("ascii")
+
+def read_header(path):
+    with open(path, "rb") as snapshot_file:
+        return json.loads(snapshot_file.readline().decode("ascii"))
+
+def write_snapshot(ledger, path):
+    """ Write a snapshot of the ledger at its tip """
+    if isinstance(ledger.blocks, SnapshotBlocks):
+        genesis = ledger.blocks.genesis
+    else:
+        try:
+            genesis = ledger.blocks[0]
+        except IndexError:
+            raise ValueError("the genesis block has been pruned, snapshots are written by nodes that keep their whole chain")
+    block = ledger.blocks[-1]
+    balances = {address: balance for address, balance in ledger.addresses.balances.items() if balance != 0}
+    header = {"version": SNAPSHOT_VERSION, "height": block.block_number, "hash": block.hash,
+        "digest": state_digest(ledger.utxo, balances), "outputs": len(ledger.utxo), "balances": len(balances)}
+
+    with open(path + ".tmp", "wb") as snapshot_file:
+        snapshot_file.write(json.dumps(header).encode("ascii") + b"\n")
+        snapshot_file.write(json.dumps(genesis.dump()).encode("ascii") + b"\n")
+        snapshot_file.write(json.dumps(block.dump()).encode("ascii") + b"\n")
+        for transaction, remaining in ledger.utxo.outputs.values():
+            snapshot_file.write(json.dumps([transaction.dump(), remaining]).encode("ascii") + b"\n")
+        for address, balance in balances.items():
+            snapshot_file.write(balance_line(address, balance) + b"\n")
+    os.replace(path + ".tmp", path)
+
+def read_snapshot(path):
+    """ Read and check a snapshot file, raises ValueError if it does not hold what its header commits to """
+    with open(path, "rb") as snapshot_file:
+        header = json.loads(snapshot_file.readline().decode("ascii"))
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("unknown snapshot version")
+        genesis = read_block(snapshot_file, 0)
+        block = read_block(snapshot_file, header["height"])
+        if block.hash != header["hash"]:
+            raise ValueError("snapshot block is not the one the header names")
+
+        outputs = []
+        for _ in range(header["outputs"]):
+            data, remaining = json.loads(snapshot_file.readline().decode("ascii"))
+            transaction = coin.Transaction.from_json(data)
+            check = copy.copy(transaction)
+            check.set_hash()
+            if check.hash != transaction.hash or type(remaining) is not int:
+                raise ValueError("snapshot output does not match its hash")
+            outputs.append((transaction, remaining))
+        balances = {}
+        for _ in range(header["balances"]):
+            address, balance = json.loads(snapshot_file.readline().decode("ascii"))
+            balances[coin.from_text(address)] = balance
+
+    snapshot = Snapshot(genesis, block, outputs, balances, header["digest"])
+    if state_digest(snapshot.unspent(), balances) != snapshot.digest:
+        raise ValueError("snapshot state does not match its digest")
+    return snapshot
+
+#Read the next block of a snapshot file and check its hash for the height it is at
+def read_block(snapshot_file, height):
+    block = coin.Block.from_json(json.loads(snapshot_file.readline().decode("ascii")))
+    provided_hash = block.hash
+    helper.label_transactions(block, height)
+    block.set_hash()
+    if block.block_number != height or block.hash != provided_hash:
+        raise ValueError("snapshot block " + str(height) + " does not match its hash")
+    return block
+
+
+#State of a ledger after one block, as read from a snapshot file
+class Snapshot:
+    def __init__ (self, genesis, block, outputs, balances, digest):
+        """ outputs is a list of (transaction, remaining value) in ledger order, balances maps addresses to their balance """
+        self.genesis = genesis
+        self.block = block
+        self.height = block.block_number
+        self.outputs = outputs
+        self.balances = balances
+        self.digest = digest
+
+    def unspent(self):
+        unspent = UnspentSet()
+        for transaction, remaining in self.outputs:
+            unspent.add(transaction, remaining)
+        return unspent
+
+    def ledger(self, history):
+        """ A ledger whose chain starts at the snapshot block, history is the Ledger of the blocks under it checked so far """
+        addresses = AddressIndex()
+        addresses.balances = dict(self.balances)
+        state = {"utxo": self.unspent(), "addresses": addresses, "heights": {self.block.hash: self.height}}
+        return coin.Ledger(SnapshotBlocks(self, history), state)
+
+
+#List-like chain of a ledger started from a snapshot, used by Ledger in place of a list
+class SnapshotBlocks:
+    def __init__ (self, snapshot, history):
+        """ Blocks from the snapshot block up, blocks under it are only held once history has checked them """
+        self.snapshot = snapshot
+        self.base = snapshot.height
+        self.genesis = snapshot.genesis
+        self.history = history
+        self.blocks = [snapshot.block]
+
+    def __len__(self):
+        return self.base + len(self.blocks)
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[index] for index in range(*height.indices(len(self)))]
+        if height < 0:
+            height = height + len(self)
+        if height >= self.base and height < len(self):
+            return self.blocks[height - self.base]
+        if height >= 0 and height < len(self.history.blocks) and height < self.base:
+            return self.history.blocks[height]
+        raise IndexError("block height out of range or under the snapshot")
+
+    #Blocks from the snapshot block up
+    def __iter__(self):
+        return iter(list(self.blocks))
+
+    def block_hash(self, height):
+        """ Hash of the block at height, None for blocks under the snapshot that have not been checked yet """
+        if height >= self.base:
+            return self.blocks[height - self.base].hash
+        if height < len(self.history.blocks):
+            return self.history.block_hash(height)
+        return None
+
+    def __delitem__(self, heights):
+        """ Only removing the top of the chain above the snapshot block is supported, as in del blocks[height:] """
+        if not isinstance(heights, slice) or heights.stop is not None or heights.step is not None:
+            raise TypeError("only del blocks[height:] is supported")
+        height = heights.indices(len(self))[0]
+        if height <= self.base:
+            raise ValueError("the snapshot block can not be removed")
+        del self.blocks[height - self.base:]
+
+    def append(self, block):
+        self.blocks.append(block)
+
+    def extend(self, blocks):
+        for block in blocks:
+            self.append(block)
+
+    def unspent(self):
+        """ Unspent set of the chain, the snapshot's with the blocks above it applied """
+        unspent = self.snapshot.unspent()
+        for block in self.blocks[1:]:
+            unspent.apply_block(block)
+        return unspent
+
+    def save(self, ledger):
+        """ Save the checked history and a snapshot at the tip, the next start carries on from them """
+        store = self.history.blocks.store
+        store.save_state(self.history)
+        write_snapshot(ledger, os.path.join(store.directory, PENDING_FILE))
+
+
+if __name__ == "__main__":
+    import blockstore
+    if len(sys.argv) != 3:
+        print("usage: python snapshot.py LEDGER_DIRECTORY SNAPSHOT_FILE")
+        raise SystemExit(1)
+    ledger = blockstore.open_ledger(sys.argv[1])
+    write_snapshot(ledger, sys.argv[2])
+    print("wrote snapshot at block " + str(ledger.current_block_number()) + " " + ledger.current_block_hash())
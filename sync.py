@@ -0,0 +1,223 @@
+"""
+
+Headers first block download
+
+A node that is behind asks a peer for the hashes of the blocks after the newest
+block they share (getHeaders / headers), then fetches the bodies in batches
+(getBlocks / syncBlock) from every peer that announced those hashes, with a
+bounded number of blocks in flight. Batches go to the source expected to answer
+first, and are asked from another source if they are not delivered in time.
+Bodies can arrive in any order and are added to the ledger in chain order, they
+come through the validation pipeline so only the ledger checks are left.
+
+"""
+
+from collections import deque
+
+#Hashes returned for one getHeaders request
+HEADERS_LIMIT = 2000
+
+#Blocks asked for in one getBlocks request
+BATCH_SIZE = 64
+
+#Blocks requested but not yet added to the ledger
+MAX_IN_FLIGHT = 1024
+
+def locator(ledger):
+    """ Hashes of our chain for a peer to find the newest block we share, densest near the tip """
+    hashes = []
+    height = ledger.current_block_number()
+    step = 1
+    while height > 0:
+        hashes.append(ledger.block_hash(height))
+        if len(hashes) >= 10:
+            step = step * 2
+        height = height - step
+    hashes.append(ledger.block_hash(0))
+    #Blocks under a snapshot the ledger started from are left out until they are checked
+    return [block_hash for block_hash in hashes if block_hash is not None]
+
+def headers_after(ledger, locator_hashes, limit):
+    """ Answer to getHeaders, [height of the first hash, hashes] of the blocks after the first known locator hash """
+    for block_hash in locator_hashes:
+        height = ledger.locate(block_hash)
+        if height is not None:
+            end = min(len(ledger.blocks), height + 1 + min(limit, HEADERS_LIMIT))
+            return [height + 1, [ledger.block_hash(next_height) for next_height in range(height + 1, end)]]
+    return [0, []]
+
+class BlockSync:
+    def __init__(self, factory):
+        self.factory = factory
+        self.reset()
+
+    def reset(self):
+        #hashes to download in chain order, and the height of the first one
+        self.chain = deque()
+        self.start_height = None
+        #hash -> peers that announced it
+        self.sources = {}
+        self.queue = deque()
+        #hash -> peer the block was asked from
+        self.in_flight = {}
+        self.sent_at = {}
+        #peer -> number of blocks in flight from it
+        self.load = {}
+        #hash -> peers that did not deliver it in time
+        self.failed = {}
+        self.received = {}
+
+    def active(self):
+        return len(self.chain) > 0
+
+    def requestHeaders(self, peer, locator_hashes=None):
+        if locator_hashes is None:
+            locator_hashes = locator(self.factory.ledger)
+        peer.sendData("getHeaders", [locator_hashes, HEADERS_LIMIT])
+
+    def receiveHeaders(self, peer, data):
+        """ Queue the announced blocks for download """
+        start_height, hashes = data
+        ledger = self.factory.ledger
+        if len(hashes) == 0:
+            return
+
+        #Ignore blocks we already have, the peer's chain can share more with ours than the locator showed
+        while len(hashes) > 0 and start_height < len(ledger.blocks) and ledger.block_hash(start_height) == hashes[0]:
+            start_height = start_height + 1
+            hashes = hashes[1:]
+
+        if self.active():
+            #Extend the chain being downloaded or add another source for it
+            end_height = self.start_height + len(self.chain)
+            if start_height > end_height or start_height < self.start_height:
+                return
+            offset = start_height - self.start_height
+            for position, block_hash in enumerate(hashes):
+                if offset + position < len(self.chain):
+                    if self.chain[offset + position] != block_hash:
+                        break
+                else:
+                    self.chain.append(block_hash)
+                    self.queue.append(block_hash)
+                self.sources.setdefault(block_hash, set()).add(peer)
+        else:
+            #Only switch to a branch that ends above our tip
+            if len(hashes) == 0 or start_height + len(hashes) - 1 <= ledger.current_block_number():
+                return
+            if start_height == 0 or start_height > len(ledger.blocks):
+                return
+            self.start_height = start_height
+            for block_hash in hashes:
+                self.chain.append(block_hash)
+                self.queue.append(block_hash)
+                self.sources.setdefault(block_hash, set()).add(peer)
+
+        #A full answer means the peer has more, ask for it while the bodies download
+        if len(hashes) == HEADERS_LIMIT:
+            self.requestHeaders(peer, [hashes[-1]])
+        self.fill()
+
+    def fill(self):
+        """ Ask for more blocks while the in flight window has room for a batch """
+        room = MAX_IN_FLIGHT - len(self.in_flight) - len(self.received)
+        if room < BATCH_SIZE and len(self.in_flight) > 0:
+            return
+        batches = {}
+        now = self.factory.reactor.seconds()
+        while len(self.queue) > 0 and len(self.in_flight) + len(self.received) < MAX_IN_FLIGHT:
+            block_hash = self.queue[0]
+            peer = self.choosePeer(block_hash)
+            if peer is None:
+                break
+            self.queue.popleft()
+            self.in_flight[block_hash] = peer
+            self.sent_at[block_hash] = now
+            self.load[peer] = self.load.get(peer, 0) + 1
+            batch = batches.setdefault(peer, [])
+            batch.append(block_hash)
+            if len(batch) >= BATCH_SIZE:
+                self.sendBatch(peer, batch)
+                batches[peer] = []
+        for peer, batch in batches.items():
+            if len(batch) > 0:
+                self.sendBatch(peer, batch)
+
+    def sendBatch(self, peer, batch):
+        peer.sendData("getBlocks", batch)
+        self.factory.reactor.callLater(self.factory.ns.REQUEST_TIMEOUT, self.batchTimeout, peer, batch)
+
+    def batchTimeout(self, peer, batch):
+        """ Ask other sources for the blocks of a batch the peer did not deliver in time """
+        late = [block_hash for block_hash in batch if self.in_flight.get(block_hash) is peer]
+        if len(late) == 0:
+            return
+        peer.recordLatency(self.factory.ns.REQUEST_TIMEOUT)
+        for block_hash in reversed(late):
+            self.requestDone(block_hash)
+            self.failed.setdefault(block_hash, set()).add(peer)
+            self.queue.appendleft(block_hash)
+        self.fill()
+
+    def choosePeer(self, block_hash):
+        """ The connected source of block_hash expected to deliver soonest, given its latency and load
+
+        Peers that already failed to deliver the block are only asked again when no other source is left.
+        """
+        peers = [peer for peer in self.sources.get(block_hash, ()) if peer.state == "CONNECTED"]
+        fresh = [peer for peer in peers if peer not in self.failed.get(block_hash, ())]
+        if len(fresh) > 0:
+            peers = fresh
+        if len(peers) == 0:
+            return None
+        return min(peers, key=lambda peer: (self.load.get(peer, 0) + 1) * peer.latency)
+
+    def requestDone(self, block_hash):
+        peer = self.in_flight.pop(block_hash)
+        del self.sent_at[block_hash]
+        self.load[peer] = self.load[peer] - 1
+        if self.load[peer] == 0:
+            del self.load[peer]
+        return peer
+
+    def receiveBlock(self, peer, block):
+        if block.hash not in self.in_flight:
+            return
+        sent_at = self.sent_at[block.hash]
+        if self.requestDone(block.hash) is peer:
+            peer.recordLatency(self.factory.reactor.seconds() - sent_at)
+        self.received[block.hash] = block
+        self.apply()
+        self.fill()
+
+    def apply(self):
+        """ Add the downloaded blocks that are next in chain order """
+        ledger = self.factory.ledger
+        advanced = False
+        while len(self.chain) > 0 and self.chain[0] in self.received:
+            block_hash = self.chain.popleft()
+            block = self.received.pop(block_hash)
+            self.sources.pop(block_hash, None)
+            self.failed.pop(block_hash, None)
+            if ledger.accept(block, checked=True) == False:
+                print("sync stopped at block " + str(block.block_number))
+                self.reset()
+                break
+            self.start_height = self.start_height + 1
+            advanced = True
+
+        if advanced:
+            print("synced to block " + str(ledger.current_block_number()))
+            self.factory.resetPOW()
+        if len(self.chain) == 0:
+            self.reset()
+
+    def peerLost(self, peer):
+        """ Ask other sources for the blocks that were in flight from a peer that went away """
+        for block_hash in list(self.in_flight):
+            if self.in_flight[block_hash] is peer:
+                self.requestDone(block_hash)
+                self.queue.appendleft(block_hash)
+        for sources in self.sources.values():
+            sources.discard(peer)
+        self.fill()
@@ -0,0 +1,63 @@
+"""
+
+Block template for the next block to mine
+
+The template holds the mempool's transactions labeled for the height above the
+tip and the Merkle tree of their hashes. Transactions are added as the mempool
+admits them, so once a nonce is found sealing the block only adds the reward to
+a copy of the tree and hashes the header fields with its root.
+
+"""
+
+import copy
+import coin
+import helper
+from merkle import MerkleBuilder
+
+class BlockTemplate:
+    def __init__ (self, ledger, processor):
+        self.ledger = ledger
+        self.processor = processor
+        self.reset([])
+
+    def reset(self, transactions):
+        """ Start over on the current tip with transactions already checked against it """
+        self.prev_hash = self.ledger.current_block_hash()
+        self.height = len(self.ledger.blocks)
+        self.transactions = []
+        self.tree = MerkleBuilder()
+        #Set when a transaction left the mempool, the template is rebuilt before it is sealed
+        self.stale = False
+        #helper.reward only reads the processor of the block it is given
+        self.reward = helper.reward(self, coin.miner_reward)
+        self.label(self.reward)
+        for transaction in transactions:
+            self.add(transaction)
+
+    #Label a transaction for the template's height the way helper.label_transactions does
+    def label(self, transaction):
+        transaction.set_block(self.height)
+        transaction.set_number(0)
+        transaction.set_hash()
+
+    def add(self, transaction):
+        """ Add a transaction the mempool admitted, the pooled object is left unlabeled """
+        transaction = copy.copy(transaction)
+        self.label(transaction)
+        self.transactions.append(transaction)
+        self.tree.add(transaction.hash)
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def seal(self, nonce):
+        """ Return the block of the template with the nonce found for the tip """
+        block = coin.Block(self.transactions + [self.reward], self.processor, self.prev_hash, nonce)
+        block.set_block_number(self.height)
+        if block.version < 2:
+            block.set_hash()
+            return block
+        tree = self.tree.copy()
+        tree.add(self.reward.hash)
+        block.hash = block.hash_with(tree.root())
+        return block
@@ -0,0 +1,229 @@
+"""
+
+Unspent transaction set maintained incrementally as blocks join the ledger
+
+"""
+
+import copy
+
+#Marks a key removed in an Overlay, and a key an Overlay holds no change for
+REMOVED = object()
+MISSING = object()
+
+#Dict held on top of another that is left unchanged, so that one can be read on another thread
+class Overlay:
+    def __init__ (self, frozen):
+        self.frozen = frozen
+        #key -> new value or REMOVED, in the order the changes would have left the keys of a dict
+        self.changes = {}
+        #keys removed from frozen and set again, they go to the end the way they do in a dict
+        self.moved = set()
+        self.size = len(frozen)
+
+    def get(self, key, default=None):
+        value = self.changes.get(key, MISSING)
+        if value is MISSING:
+            return self.frozen.get(key, default)
+        return default if value is REMOVED else value
+
+    def __getitem__(self, key):
+        value = self.get(key, REMOVED)
+        if value is REMOVED:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, REMOVED) is not REMOVED
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.size = self.size + 1
+            if key in self.changes:
+                del self.changes[key]
+                if key in self.frozen:
+                    self.moved.add(key)
+        self.changes[key] = value
+
+    def pop(self, key, default=None):
+        value = self.get(key, REMOVED)
+        if value is REMOVED:
+            return default
+        self.changes[key] = REMOVED
+        self.size = self.size - 1
+        return value
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for key in self.frozen:
+            value = self.changes.get(key, MISSING)
+            if value is MISSING or (value is not REMOVED and key not in self.moved):
+                yield key
+        for key, value in self.changes.items():
+            if value is not REMOVED and (key in self.moved or key not in self.frozen):
+                yield key
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        return (self[key] for key in self)
+
+    def items(self):
+        return ((key, self[key]) for key in self)
+
+    def merged(self):
+        """ Apply the changes to the frozen dict and return it, once nothing reads it any more """
+        for key, value in self.changes.items():
+            if value is REMOVED:
+                self.frozen.pop(key, None)
+            else:
+                if key in self.moved:
+                    del self.frozen[key]
+                self.frozen[key] = value
+        return self.frozen
+
+
+#Unspent transactions keyed by transaction hash
+class UnspentSet:
+    def __init__ (self):
+        #transaction hash -> (transaction, remaining value)
+        self.outputs = {}
+        #receiver address -> hashes of its unspent transactions, in ledger order
+        self.by_address = {}
+
+    #Only the outputs are pickled, the hashes of each address are listed again in the order the outputs joined
+    def __getstate__(self):
+        return {"outputs": self.outputs if type(self.outputs) is dict else dict(self.outputs)}
+
+    def __setstate__(self, state):
+        self.outputs = state["outputs"]
+        self.by_address = state.get("by_address")
+        if self.by_address is None:
+            self.by_address = {}
+            for transaction_hash, entry in self.outputs.items():
+                self.by_address.setdefault(entry[0].receiver, {})[transaction_hash] = None
+
+    def freeze(self):
+        """ Unspent set of the outputs as they are now, to be pickled on another thread
+
+        The outputs are not copied, the changes made to this set until thaw() is
+        called are held on top of them.
+        """
+        frozen = UnspentSet()
+        frozen.outputs = self.outputs
+        self.outputs = Overlay(self.outputs)
+        return frozen
+
+    def thaw(self):
+        if isinstance(self.outputs, Overlay):
+            self.outputs = self.outputs.merged()
+
+    #Build the set by replaying a list of blocks, used when a ledger is loaded
+    @classmethod
+    def from_blocks(cls, blocks):
+        unspent = cls()
+        for block in blocks:
+            unspent.apply_block(block)
+        return unspent
+
+    def apply_block(self, block):
+        """ Spend the inputs and add the outputs of a block that joined the ledger
+
+        Returns the block's undo journal for undo_block, the (transaction hash,
+        entry it replaced) of each change in order, None for outputs that are new.
+        """
+        journal = []
+        for transaction in block.transactions:
+            for input_hash in transaction.input_transaction_hashes:
+                entry = self.spend(input_hash)
+                if entry is not None:
+                    journal.append((input_hash, entry))
+            previous = self.outputs.get(transaction.hash)
+            if previous is not None:
+                self.unlink(transaction.hash, previous)
+            journal.append((transaction.hash, previous))
+            self.outputs[transaction.hash] = (transaction, transaction.value)
+            self.by_address.setdefault(transaction.receiver, {})[transaction.hash] = None
+        return journal
+
+    def undo_block(self, journal):
+        """ Take a block back out of the set, journal is what apply_block returned for it
+
+        Outputs put back are unspent again at the end of their address's order.
+        """
+        for transaction_hash, previous in reversed(journal):
+            current = self.outputs.pop(transaction_hash, None)
+            if current is not None:
+                self.unlink(transaction_hash, current)
+            if previous is not None:
+                self.add(previous[0], previous[1])
+
+    #Copy that can be changed without changing this set, the transactions are shared
+    def copy(self):
+        unspent = UnspentSet()
+        unspent.outputs = dict(self.outputs)
+        unspent.by_address = {address: dict(hashes) for address, hashes in self.by_address.items()}
+        return unspent
+
+    #Add an output with the value left in it, used when the set is read from a snapshot
+    def add(self, transaction, remaining):
+        self.outputs[transaction.hash] = (transaction, remaining)
+        self.by_address.setdefault(transaction.receiver, {})[transaction.hash] = None
+
+    #Remove an output, returns its entry or None if it was not unspent
+    def spend(self, transaction_hash):
+        entry = self.outputs.pop(transaction_hash, None)
+        if entry is not None:
+            self.unlink(transaction_hash, entry)
+        return entry
+
+    def unlink(self, transaction_hash, entry):
+        hashes = self.by_address.get(entry[0].receiver, {})
+        hashes.pop(transaction_hash, None)
+        if len(hashes) == 0:
+            self.by_address.pop(entry[0].receiver, None)
+
+    #Hashes of the unspent transactions received by an address
+    def address_hashes(self, address):
+        return list(self.by_address.get(address, ()))
+
+    def __contains__(self, transaction_hash):
+        return transaction_hash in self.outputs
+
+    def __len__(self):
+        return len(self.outputs)
+
+    #Return an overlay for checking a block without touching the ledger state
+    def view(self):
+        return UnspentView(self)
+
+
+#Copy-on-write overlay used by process_block and valid_block
+class UnspentView:
+    def __init__ (self, base):
+        self.base = base
+        self.touched = {}
+
+    def get(self, transaction_hash):
+        """ Return a private copy of an unspent transaction, None if it is spent or unknown
+
+        The copy carries the remaining value in its value field so callers can
+        reduce it while checking a block, only the outputs a block touches are copied
+        """
+        if transaction_hash in self.touched:
+            return self.touched[transaction_hash]
+
+        entry = self.base.outputs.get(transaction_hash)
+        if entry is None:
+            return None
+
+        unspent_transaction = copy.copy(entry[0])
+        unspent_transaction.value = entry[1]
+        self.touched[transaction_hash] = unspent_transaction
+        return unspent_transaction
+
+    #All unspent transactions, copied, in the order they joined the ledger
+    def all(self):
+        return [self.get(transaction_hash) for transaction_hash in self.base.outputs]
@@ -0,0 +1,75 @@
+"""
+
+Block checks done on worker threads
+
+Blocks sent by peers are decoded and given every check that does not need the
+ledger (proof of work, signatures, transaction labels and block hash) on the
+reactor's thread pool. The results come back to the reactor in the order the
+blocks arrived, where Ledger.add only has to check them against the unspent set.
+
+"""
+
+from collections import deque
+from twisted.internet import threads
+import coin
+import helper
+import signatures
+
+def check_block(block):
+    """ Checks of a block that do not need the ledger, returns False if any fail """
+    if not isinstance(block.block_number, int) or block.block_number < 1 or len(block.transactions) == 0:
+        return False
+    if helper.check_nonce(block.prev_hash, block.nonce, coin.POW_difficulty) == False:
+        return False
+
+    #The last transaction is the miner reward, Ledger.add checks it
+    if False in signatures.verify_transactions(helper.signed_transactions(block.transactions[:-1])):
+        print("transaction not verified")
+        return False
+
+    #Label for the height the block claims, Ledger.add makes sure it is the next one
+    helper.label_transactions(block, block.block_number)
+    provided_hash = block.hash
+    block.set_hash()
+    if block.hash != provided_hash:
+        print("could not duplicate hash")
+        return False
+    return True
+
+#Run on a worker thread, returns (command, block, True if its checks passed)
+def prepare(decode, message):
+    command, block = decode(message)
+    return (command, block, check_block(block))
+
+
+class ValidationPipeline:
+    def __init__ (self, run_in_thread=threads.deferToThread):
+        """ run_in_thread(function, *args) runs function on a worker thread and returns a Deferred """
+        self.run_in_thread = run_in_thread
+        #[done, result, commit] for each block in the order it arrived
+        self.queue = deque()
+
+    def submit(self, decode, message, commit):
+        """ Decode message and check its block on a worker thread, commit(result) is called on the reactor in order """
+        entry = [False, None, commit]
+        self.queue.append(entry)
+        d = self.run_in_thread(prepare, decode, message)
+        d.addCallbacks(self.done, self.failed, callbackArgs=(entry,), errbackArgs=(entry,))
+
+    def done(self, result, entry):
+        entry[0] = True
+        entry[1] = result
+        while len(self.queue) > 0 and self.queue[0][0]:
+            done, result, commit = self.queue.popleft()
+            if result is not None:
+                try:
+                    commit(result)
+                except Exception as e:
+                    print(e)
+
+    def failed(self, failure, entry):
+        """ Messages that could not be decoded are dropped """
+        self.done(None, entry)
+
+    def __len__(self):
+        return len(self.queue)
@@ -0,0 +1,363 @@
+"""
+
+Message encodings for the peer protocol
+
+Peers start out sending JSON lines, ["command", data]. Both sides announce their
+height and the features they support with a version message, and a side that sees
+"binary" in its peer's features sends a last "binary" line and switches its output
+to frames:
+
+    4 byte big endian length, 1 byte command code, payload
+
+Blocks and transactions are encoded field by field, with hashes, keys and
+signatures sent as raw bytes instead of hex text. Version 2 transactions are
+sent as the canonical encoding their signature covers, so the receiver checks
+the bytes it read without encoding them again. Commands without a code of their
+own are sent as code 0 with the JSON message as payload.
+
+"""
+
+import json
+import struct
+import coin
+
+FEATURES = ["binary", "headers", "inv", "history"]
+
+#Frames larger than this are treated as a broken connection
+MAX_FRAME = 64 * 1024 * 1024
+
+#Commands whose data is a block or a transaction
+BLOCK_COMMANDS = ("newBlock", "getBlock", "syncBlock", "historyBlock")
+TRANSACTION_COMMANDS = ("transaction",)
+
+#Command codes, position in the list is the code
+COMMANDS = [None, "ping", "pong", "sendPeers", "receivePeers", "newBlock", "getBlock",
+    "returnBlock", "returnNextBlock", "transaction", "syncBlock", "historyBlock"]
+CODES = {command: code for code, command in enumerate(COMMANDS) if command is not None}
+
+FRAME_HEADER = struct.Struct(">IB")
+#sender, receiver, hash, signature, block, number, input_value, value length, input count
+COMPACT_TRANSACTION = struct.Struct(">32s32s32s64sqqqBH")
+#signature, block, number, input_value, hash, sent after a canonical encoding
+COMPACT_LABELS = struct.Struct(">64sqqq32s")
+COUNT = struct.Struct(">I")
+INTEGER = struct.Struct(">q")
+FLOAT = struct.Struct(">d")
+
+#Transaction forms
+GENERIC_TRANSACTION = 0
+SIGNED_TRANSACTION = 1
+CANONICAL_TRANSACTION = 2
+LABELED_TRANSACTION = 3
+
+#Value tags
+JSON_VALUE = 0
+HEX_BYTES = 1
+HEX_STRING = 2
+RAW_BYTES = 3
+INTEGER_VALUE = 4
+FLOAT_VALUE = 5
+TEXT = 6
+
+HEX_DIGITS = frozenset("0123456789abcdef")
+
+class WireError(Exception):
+    pass
+
+
+#True if value is lowercase hex that bytes.hex() gives back unchanged
+def is_hex(text):
+    return len(text) % 2 == 0 and len(text) <= 510 and HEX_DIGITS.issuperset(text)
+
+def is_ascii(text):
+    try:
+        text.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return True
+
+def encode_value(value, out):
+    """ Append one tagged value to the bytearray out """
+    if isinstance(value, bytes):
+        text = value.decode("latin-1")
+        if is_hex(text):
+            out.append(HEX_BYTES)
+            out.append(len(value) // 2)
+            out += bytes.fromhex(text)
+        else:
+            out.append(RAW_BYTES)
+            out += COUNT.pack(len(value))
+            out += value
+    elif isinstance(value, str) and is_hex(value):
+        out.append(HEX_STRING)
+        out.append(len(value) // 2)
+        out += bytes.fromhex(value)
+    elif isinstance(value, str) and len(value) < 256 and is_ascii(value):
+        out.append(TEXT)
+        out.append(len(value))
+        out += value.encode("ascii")
+    elif is_integer(value):
+        out.append(INTEGER_VALUE)
+        out += INTEGER.pack(value)
+    elif type(value) is float:
+        out.append(FLOAT_VALUE)
+        out += FLOAT.pack(value)
+    else:
+        data = json.dumps(value).encode("ascii")
+        out.append(JSON_VALUE)
+        out += COUNT.pack(len(data))
+        out += data
+
+def decode_value(data, position):
+    """ Read one tagged value, returns (value, next position) """
+    tag = data[position]
+    position = position + 1
+    if tag == HEX_BYTES or tag == HEX_STRING or tag == TEXT:
+        length = data[position]
+        raw = bytes(data[position + 1:position + 1 + length])
+        if len(raw) != length:
+            raise WireError("truncated value")
+        position = position + 1 + length
+        if tag == HEX_BYTES:
+            return raw.hex().encode("ascii"), position
+        if tag == HEX_STRING:
+            return raw.hex(), position
+        return raw.decode("ascii"), position
+    if tag == INTEGER_VALUE:
+        return INTEGER.unpack_from(data, position)[0], position + INTEGER.size
+    if tag == FLOAT_VALUE:
+        return FLOAT.unpack_from(data, position)[0], position + FLOAT.size
+    if tag == RAW_BYTES or tag == JSON_VALUE:
+        length = COUNT.unpack_from(data, position)[0]
+        position = position + COUNT.size
+        raw = bytes(data[position:position + length])
+        if len(raw) != length:
+            raise WireError("truncated value")
+        if tag == RAW_BYTES:
+            return raw, position + length
+        return json.loads(raw.decode("ascii")), position + length
+    raise WireError("unknown value tag " + str(tag))
+
+def encode_list(values, out):
+    out += COUNT.pack(len(values))
+    for value in values:
+        encode_value(value, out)
+
+def decode_list(data, position):
+    count = COUNT.unpack_from(data, position)[0]
+    position = position + COUNT.size
+    values = []
+    for _ in range(count):
+        value, position = decode_value(data, position)
+        values.append(value)
+    return values, position
+
+
+def is_integer(value):
+    return type(value) is int and -2**63 <= value < 2**63
+
+#True if a transaction fits the fixed layout of an ordinary signed transaction, digests held as raw bytes are lowercase hex
+def is_compact(transaction, value):
+    return (type(transaction.raw_sender) is bytes and type(transaction.raw_receiver) is bytes and is_labeled(transaction)
+        and len(value) < 256 and is_ascii(value) and type(transaction.raw_inputs) is bytes and len(transaction.raw_inputs) < 32 * 65536)
+
+#True if a signed transaction in a block has labels that fit COMPACT_LABELS
+def is_labeled(transaction):
+    return (type(transaction.raw_signature) is bytes and type(transaction.raw_hash) is bytes
+        and is_integer(transaction.block) and is_integer(transaction.number) and is_integer(transaction.input_value))
+
+#Version 2 transactions are sent as their canonical encoding followed by the fields it leaves out
+def encode_transaction(transaction, out):
+    if transaction.version >= 2:
+        if is_labeled(transaction):
+            out.append(LABELED_TRANSACTION)
+            out += transaction.signed_bytes()
+            out += COMPACT_LABELS.pack(transaction.raw_signature, transaction.block, transaction.number,
+                transaction.input_value, transaction.raw_hash)
+            return
+        out.append(CANONICAL_TRANSACTION)
+        out += transaction.signed_bytes()
+        for value in (transaction.signature, transaction.block, transaction.number, transaction.input_value, transaction.hash):
+            encode_value(value, out)
+        return
+
+    #Fields in the order Transaction.dump lists them, signed transactions use one fixed layout
+    value = transaction.amount()
+    if is_compact(transaction, value):
+        out.append(SIGNED_TRANSACTION)
+        out += COMPACT_TRANSACTION.pack(transaction.raw_sender, transaction.raw_receiver, transaction.raw_hash,
+            transaction.raw_signature, transaction.block, transaction.number, transaction.input_value, len(value),
+            len(transaction.raw_inputs) // 32)
+        out += value.encode("ascii")
+        out += transaction.raw_inputs
+        return
+
+    out.append(GENERIC_TRANSACTION)
+    encode_list(transaction.input_transaction_hashes, out)
+    for value in (value, transaction.sender, transaction.receiver, transaction.block,
+            transaction.number, transaction.input_value, transaction.hash, transaction.signature):
+        encode_value(value, out)
+
+def decode_transaction(data, position):
+    form = data[position]
+    position = position + 1
+    if form == CANONICAL_TRANSACTION or form == LABELED_TRANSACTION:
+        try:
+            transaction, position = coin.Transaction.from_body(data, position)
+        except (ValueError, IndexError, struct.error) as e:
+            raise WireError("bad transaction: " + str(e))
+        if form == LABELED_TRANSACTION:
+            (transaction.raw_signature, transaction.block, transaction.number, transaction.input_value,
+                transaction.raw_hash) = COMPACT_LABELS.unpack_from(data, position)
+            return transaction, position + COMPACT_LABELS.size
+        fields = []
+        for _ in range(5):
+            value, position = decode_value(data, position)
+            fields.append(value)
+        transaction.signature, transaction.block, transaction.number, transaction.input_value, transaction.hash = fields
+        return transaction, position
+    if form == SIGNED_TRANSACTION:
+        sender, receiver, transaction_hash, signature, block, number, input_value, value_length, count = COMPACT_TRANSACTION.unpack_from(data, position)
+        position = position + COMPACT_TRANSACTION.size
+        value = bytes(data[position:position + value_length]).decode("ascii")
+        position = position + value_length
+        inputs = bytes(data[position:position + 32 * count])
+        position = position + 32 * count
+        if position > len(data):
+            raise WireError("truncated transaction")
+        transaction = coin.Transaction.from_raw(inputs, 0, sender, receiver)
+        transaction.set_amount(value)
+        transaction.block = block
+        transaction.number = number
+        transaction.input_value = input_value
+        transaction.raw_hash = transaction_hash
+        transaction.raw_signature = signature
+        transaction.version = 1
+        return transaction, position
+    if form != GENERIC_TRANSACTION:
+        raise WireError("unknown transaction form " + str(form))
+
+    input_transaction_hashes, position = decode_list(data, position)
+    fields = []
+    for _ in range(8):
+        value, position = decode_value(data, position)
+        fields.append(value)
+    transaction = coin.Transaction(input_transaction_hashes, 0, fields[1], fields[2])
+    transaction.set_amount(fields[0])
+    transaction.block = fields[3]
+    transaction.number = fields[4]
+    transaction.input_value = fields[5]
+    transaction.hash = fields[6]
+    transaction.signature = fields[7]
+    transaction.version = 1
+    return transaction, position
+
+#Fields in the order Block.dump lists them, then the transactions
+def encode_block(block, out):
+    for value in (block.timestamp, block.processor, block.prev_hash, block.hash, block.block_number,
+            block.nonce, block.POW_difficulty, block.version):
+        encode_value(value, out)
+    out += COUNT.pack(len(block.transactions))
+    for transaction in block.transactions:
+        encode_transaction(transaction, out)
+
+def decode_block(data, position):
+    fields = []
+    for _ in range(8):
+        value, position = decode_value(data, position)
+        fields.append(value)
+    count = COUNT.unpack_from(data, position)[0]
+    position = position + COUNT.size
+    transactions = []
+    for _ in range(count):
+        transaction, position = decode_transaction(data, position)
+        transactions.append(transaction)
+    block = coin.Block(transactions, fields[1], fields[2], fields[5])
+    block.timestamp = fields[0]
+    block.hash = fields[3]
+    block.block_number = fields[4]
+    block.POW_difficulty = fields[6]
+    block.version = fields[7]
+    return block, position
+
+
+def encode_frame(command, data):
+    """ Encode one message as a binary frame """
+    code = CODES.get(command, 0)
+    out = bytearray(FRAME_HEADER.size)
+    if code == 0:
+        out += encode_line(command, data)
+    elif command in BLOCK_COMMANDS:
+        encode_block(data, out)
+    elif command in TRANSACTION_COMMANDS:
+        encode_transaction(data, out)
+    else:
+        encode_value(data, out)
+    FRAME_HEADER.pack_into(out, 0, len(out) - COUNT.size, code)
+    return bytes(out)
+
+#Header of a frame whose payload is sent separately, as a block payload read from the block store
+def frame_header(command, payload_length):
+    return FRAME_HEADER.pack(payload_length + 1, CODES[command])
+
+def decode_frame(frame):
+    """ Decode the body of a frame (code and payload) into (command, data) """
+    code = frame[0]
+    if code == 0:
+        return decode_line(frame[1:])
+    if code >= len(COMMANDS):
+        raise WireError("unknown command code " + str(code))
+    command = COMMANDS[code]
+    if command in BLOCK_COMMANDS:
+        data, position = decode_block(frame, 1)
+    elif command in TRANSACTION_COMMANDS:
+        data, position = decode_transaction(frame, 1)
+    else:
+        data, position = decode_value(frame, 1)
+    if position != len(frame):
+        raise WireError("trailing bytes in frame")
+    return command, data
+
+def frame_command(frame):
+    """ Command of a frame body without decoding its payload, None for JSON payloads """
+    if frame[0] == 0 or frame[0] >= len(COMMANDS):
+        return None
+    return COMMANDS[frame[0]]
+
+def read_frames(buffer):
+    """ Remove the complete frames at the start of a bytearray, returns their bodies """
+    frames = []
+    while len(buffer) >= COUNT.size:
+        length = COUNT.unpack_from(buffer, 0)[0]
+        if length == 0 or length > MAX_FRAME:
+            raise WireError("bad frame length " + str(length))
+        if len(buffer) < COUNT.size + length:
+            break
+        frames.append(bytes(buffer[COUNT.size:COUNT.size + length]))
+        del buffer[:COUNT.size + length]
+    return frames
+
+
+def encode_line(command, data):
+    """ Encode one message as a JSON line, without the delimiter """
+    if isinstance(data, (coin.Block, coin.Transaction)):
+        data = data.dump()
+    return json.dumps([command, data]).encode("ascii")
+
+def line_command(line):
+    """ Command of a line written by encode_line without decoding it, None if the line looks different """
+    if line[:2] != b'["':
+        return None
+    end = line.find(b'"', 2)
+    if end == -1:
+        return None
+    return bytes(line[2:end]).decode("ascii", "replace")
+
+def decode_line(line):
+    """ Decode a JSON line into (command, data), blocks and transactions are loaded into objects """
+    command, data = json.loads(bytes(line).decode("ascii"))
+    if command in BLOCK_COMMANDS:
+        data = coin.Block.from_json(data)
+    elif command in TRANSACTION_COMMANDS:
+        data = coin.Transaction.from_json(data)
+    return command, data
@@ -5,12 +5,17 @@ Main file for running a blockchain node
 "python xcoin.py" creates a command line interface for running the node
 "python xcoin.py -d" creates a peer for running on a docker simulations without commandline input
 "python xcoin.py -m" creates a peer mirror for running a peer on your local machine
+"python xcoin.py --asyncio" runs the node on an asyncio event loop instead of Twisted
+"python xcoin.py --snapshot snapshot.dat" starts a node with no chain yet from a UTXO snapshot, see snapshot.py
+"python xcoin.py --prune 100" runs a pruned node that keeps the unspent set and only the newest 100 blocks in full
 
 """
 
 from node import NodeFactory
+from blockstore import open_ledger, save_ledger
 
 import argparse
+import os
 import pickle
 from twisted.internet.protocol import Factory, ClientFactory
 from twisted.protocols.basic import LineReceiver
@@ -37,6 +42,9 @@ parser.add_argument("-m", "--mirror", help="run node as a mirror", action="store
 parser.add_argument("-n", "--nirror", help="run node as a mirror", action="store_true")
 parser.add_argument("-b", "--bootstrap", help="run as docker bootstrap", action="store_true")
 parser.add_argument("-p", "--peer", help="run as docker peer, add additional bootstrap address", action="store_true")
+parser.add_argument("-a", "--asyncio", help="run node on an asyncio event loop", action="store_true")
+parser.add_argument("-s", "--snapshot", help="start from this UTXO snapshot if there is no chain yet", type=str)
+parser.add_argument("--prune", help="keep only this many recent blocks in full", type=int)
 parser.add_argument("address", nargs='?', help="print out if p tag", type=str)
 args = parser.parse_args()
 if args.mirror:
@@ -71,8 +79,8 @@ else:
 #Set configuration for network settings
 PEER_LIST_SIZE = 30
 
-#Import python ledger object, data type to be updated to allow easier modifictaion
-ledger = pickle.load( open(ledger_dir, "rb" ) )
+#Open the block store next to the pickled ledger, the pickle or the snapshot is only read to fill a new store
+ledger = open_ledger(os.path.splitext(ledger_dir)[0], ledger_dir, args.snapshot, args.prune)
 
 #Import secret key
 seed = pickle.load( open(seed_dir, "rb") )
@@ -86,8 +94,19 @@ print(pubkey)
 #Enter address for node block rewards
 my_address = pubkey
 
+if args.asyncio:
+    import asyncio_node
+    asyncio_node.run(ledger, my_address, signing_key, PORT, PEER_PORT, ns, BOOTSTRAP_ADDRESS if args.peer else None)
+    save_ledger(ledger, ledger_dir)
+    raise SystemExit
+
 factory = NodeFactory(reactor, ledger, my_address, signing_key, PEER_PORT, "myIP", ns)
 reactor.callLater(5, factory.startPOW)
+reactor.addSystemEventTrigger("before", "shutdown", factory.miner.stop)
+reactor.addSystemEventTrigger("before", "shutdown", save_ledger, ledger, ledger_dir)
+
+#Pings measure the latency used to pick which peer to ask for blocks
+LoopingCall(factory.pingPeers).start(ns.PING_INTERVAL, now=False)
 
 stdio.StandardIO(factory.buildCommandProtocol())
 